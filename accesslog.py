@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Access log written off the event loop.
+
+The event loop only appends a tuple of request fields to a bounded ring
+buffer.  A background thread wakes up every flush_interval seconds (or
+earlier when the buffer is half full), formats the whole batch and writes it
+to the log file with one write() call, so a slow disk never stalls the
+connections of the worker.
+
+When the buffer is full the "drop" policy discards the record (the number of
+dropped records is written to the log with the next batch), the "block"
+policy makes the event loop wait for the writer thread.
+"""
+import os
+import random
+import threading
+from time import strftime, localtime
+
+# Common Log Format
+DEFAULT_FORMAT = '%(remote_addr)s - - [%(time)s] "%(method)s %(uri)s %(protocol)s" %(status)s %(bytes)s'
+
+POLICIES = ("drop", "block")
+
+_FIELDS = ("remote_addr", "timestamp", "method", "uri", "protocol", "status", "bytes")
+
+
+class AccessLog(object):
+
+    def __init__(self, path, log_format=DEFAULT_FORMAT, buffer_size=4096, policy="drop", sample=1.0,
+                 flush_interval=0.5):
+        if policy not in POLICIES:
+            raise ValueError("unknown access log policy %r" % policy)
+        self.path = path
+        self.log_format = log_format
+        self.policy = policy
+        self.sample = sample
+        self.flush_interval = flush_interval
+        self.fd = None
+        # ring buffer: records[head] is the oldest record, count records follow it
+        self.records = [None] * buffer_size
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.writer = None
+
+    def start(self):
+        """opens the log file and starts the writer thread, must be called in the worker process"""
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def record(self, remote_addr, timestamp, method, uri, protocol, status, length):
+        """queues one access record, called from the event loop"""
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        size = len(self.records)
+        with self.lock:
+            while self.count == size:
+                if self.policy == "drop" or self.closed:
+                    self.dropped += 1
+                    return
+                self.space.wait()
+            self.records[(self.head + self.count) % size] = (remote_addr, timestamp, method, uri, protocol,
+                                                             status, length)
+            self.count += 1
+            if self.count == size // 2:
+                self.wakeup.notify()
+
+    def _take(self):
+        """returns buffered records and number of dropped ones, empties the ring buffer"""
+        size = len(self.records)
+        end = self.head + self.count
+        if end <= size:
+            batch = self.records[self.head:end]
+        else:
+            batch = self.records[self.head:] + self.records[:end - size]
+        dropped = self.dropped
+        self.head = end % size
+        self.count = 0
+        self.dropped = 0
+        self.space.notify_all()
+        return batch, dropped
+
+    def _format(self, batch, dropped):
+        lines = []
+        fields = {}
+        for record in batch:
+            fields.update(zip(_FIELDS, record))
+            fields["time"] = strftime("%d/%b/%Y:%H:%M:%S %z", localtime(fields["timestamp"]))
+            lines.append(self.log_format % fields)
+        if dropped:
+            lines.append("access log buffer was full, %d records dropped" % dropped)
+        lines.append("")
+        return "\n".join(lines).encode("utf-8", "replace")
+
+    def _write_loop(self):
+        while True:
+            with self.lock:
+                if not self.count and not self.dropped and not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                batch, dropped = self._take()
+                closed = self.closed
+            if batch or dropped:
+                self._write(self._format(batch, dropped))
+            if closed:
+                return
+
+    def _write(self, data):
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except OSError:
+                # the log is lost rather than the worker
+                return
+            data = data[written:]
+
+    def close(self):
+        """writes out buffered records and closes the log file"""
+        if self.writer is None:
+            return
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.writer.join(5.0)
+        os.close(self.fd)
+        self.writer = None
+
+
+def format_is_valid(log_format):
+    """returns True if log_format uses only known fields"""
+    fields = dict((name, 0) for name in _FIELDS)
+    fields["time"] = ""
+    try:
+        log_format % fields
+    except (KeyError, ValueError, TypeError):
+        return False
+    return True
@@ -47,17 +47,28 @@ sophisticated high-performance network servers and clients a snap.
 import select
 import socket
 import sys
+import threading
 import time
 import warnings
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import os
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
      ENOTCONN, ESHUTDOWN, EISCONN, EBADF, ECONNABORTED, EPIPE, EAGAIN, \
-     errorcode
+     EINTR, ENOENT, EEXIST, errorcode
 
 _DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE,
                            EBADF))
 
+# readiness bits reported back to edge-triggered pollers
+_POLLIN = getattr(select, 'POLLIN', 1) | getattr(select, 'POLLPRI', 2)
+_POLLOUT = getattr(select, 'POLLOUT', 4)
+
 try:
     socket_map
 except NameError:
@@ -202,34 +213,172 @@ def poll_poller(timeout=0.0, map=None):
 poll = select_poller
 poll2 = poll3 = poll_poller
 
-def epoll_poller(timeout=0.0, map=None):
-    """A poller which uses epoll(), supported on Linux 2.5.44 and newer."""
-    if map is None:
-        map = socket_map
-    pollster = select.epoll()
-    if map:
-        for fd, obj in map.items():
-            flags = 0
-            if obj.readable():
-                flags |= select.POLLIN | select.POLLPRI
-            if obj.writable():
-                flags |= select.POLLOUT
-            if flags:
-                # Only check for exceptions if object was either readable
-                # or writable.
-                flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
-                pollster.register(fd, flags)
+_EPOLLRDHUP = getattr(select, 'EPOLLRDHUP', 0x2000)
+
+# persistent pollers attached to socket maps, keyed by id(map), so that
+# dispatchers can report interest changes without scanning the whole map
+_reactors = {}
+
+class epoll_reactor:
+    """A long-lived poller which keeps one epoll() object per socket map.
+
+    Interest masks are only recomputed for descriptors which were added to
+    the map, had events on the previous pass or were touched through
+    dispatcher.update_interest(), and epoll_ctl() is only called when the
+    readable()/writable() answer actually changed.  The cost of a wakeup
+    therefore depends on the number of ready descriptors, not on the number
+    of open ones.
+
+    With edge_triggered=True every descriptor is registered once for both
+    directions with EPOLLET.  The reactor remembers the readiness reported by
+    the kernel and keeps serving it while the dispatcher is interested,
+    until recv()/send()/accept() run into EWOULDBLOCK.
+    """
+
+    def __init__(self, map=None, edge_triggered=False):
+        if map is None:
+            map = socket_map
+        self.map = map
+        self.edge_triggered = edge_triggered
+        self._epoll = select.epoll()
+        self._registered = {}   # fd -> mask installed in the kernel
+        self._ready = {}        # fd -> readiness not consumed yet (ET only)
+        self._dirty = set(map)  # fds which interest must be re-evaluated
+        old = _reactors.get(id(map))
+        if old is not None:
+            old.close()
+        _reactors[id(map)] = self
+
+    def close(self):
+        if _reactors.get(id(self.map)) is self:
+            del _reactors[id(self.map)]
+        self._epoll.close()
+        self._registered.clear()
+        self._ready.clear()
+        self._dirty.clear()
+
+    def touch(self, fd):
+        self._dirty.add(fd)
+
+    def forget(self, fd):
+        # called while fd is still open, before it is removed from the map:
+        # once the socket is closed the number can be reused by accept()
+        self._dirty.discard(fd)
+        self._ready.pop(fd, None)
+        if self._registered.pop(fd, None) is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def would_block(self, fd, flags):
+        ready = self._ready.get(fd)
+        if ready:
+            self._ready[fd] = ready & ~flags
+
+    def interest(self, obj):
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        return flags
+
+    def _ctl(self, fd, flags):
+        registered = self._registered.get(fd)
+        if registered == flags or (registered is None and not flags):
+            return
+        if not flags:
+            self.forget(fd)
+            return
         try:
-            r = pollster.poll(timeout)
-        except select.error, err:
+            if registered is None:
+                self._epoll.register(fd, flags)
+            else:
+                self._epoll.modify(fd, flags)
+        except (IOError, OSError) as err:
+            # the descriptor was closed behind our back and its number reused
+            if err.args[0] == ENOENT:
+                self._epoll.register(fd, flags)
+            elif err.args[0] == EEXIST:
+                self._epoll.modify(fd, flags)
+            else:
+                raise
+        self._registered[fd] = flags
+
+    def poll(self, timeout=0.0, map=None):
+        map = self.map
+        dirty = self._dirty
+        self._dirty = set()
+        edge_triggered = self.edge_triggered
+        runnable = set()
+        for fd in dirty:
+            obj = map.get(fd)
+            if obj is None:
+                self.forget(fd)
+            elif not edge_triggered:
+                self._ctl(fd, self.interest(obj))
+            else:
+                if fd not in self._registered:
+                    self._ctl(fd, select.EPOLLIN | select.EPOLLPRI |
+                              select.EPOLLOUT | _EPOLLRDHUP | select.EPOLLET)
+                if self._ready.get(fd, 0) & self.interest(obj):
+                    runnable.add(fd)
+
+        if runnable or timeout is None or timeout < 0:
+            timeout = 0 if runnable else -1
+        try:
+            events = self._epoll.poll(timeout)
+        except (IOError, OSError) as err:
             if err.args[0] != EINTR:
                 raise
-            r = []
-        for fd, flags in r:
+            events = []
+
+        if not edge_triggered:
+            for fd, flags in events:
+                obj = map.get(fd)
+                if obj is None:
+                    continue
+                readwrite(obj, flags)
+                self._dirty.add(fd)
+            return
+
+        ready = self._ready
+        for fd, flags in events:
+            if flags & _EPOLLRDHUP:
+                flags |= select.EPOLLIN
+            ready[fd] = ready.get(fd, 0) | flags
+            runnable.add(fd)
+        for fd in runnable:
             obj = map.get(fd)
             if obj is None:
                 continue
-            readwrite(obj, flags)
+            flags = ready.get(fd, 0)
+            errors = flags & (select.EPOLLERR | select.EPOLLHUP)
+            if errors:
+                ready[fd] = flags & ~errors
+            flags &= self.interest(obj) | errors
+            if flags:
+                readwrite(obj, flags)
+            self._dirty.add(fd)
+
+def _epoll_reactor(map, edge_triggered):
+    if map is None:
+        map = socket_map
+    reactor = _reactors.get(id(map))
+    if reactor is None or reactor.edge_triggered != edge_triggered:
+        reactor = epoll_reactor(map, edge_triggered)
+    return reactor
+
+def epoll_poller(timeout=0.0, map=None):
+    """A poller which uses epoll(), supported on Linux 2.5.44 and newer.
+    The epoll object survives between calls, see epoll_reactor."""
+    _epoll_reactor(map, False).poll(timeout)
+
+def epoll_et_poller(timeout=0.0, map=None):
+    """Same as epoll_poller(), but with edge-triggered notifications."""
+    _epoll_reactor(map, True).poll(timeout)
 
 def kqueue_poller(timeout=0.0, map=None):
     """A poller which uses kqueue(), BSD specific."""
@@ -263,24 +412,174 @@ def kqueue_poller(timeout=0.0, map=None):
         kqueue.close()
 
 
+pollers = {'select': select_poller}
+if hasattr(select, 'poll'):
+    pollers['poll'] = poll_poller
+if hasattr(select, 'epoll'):
+    pollers['epoll'] = epoll_poller
+    pollers['epoll_et'] = epoll_et_poller
+if hasattr(select, 'kqueue'):
+    pollers['kqueue'] = kqueue_poller
+
+def get_poller(name):
+    try:
+        return pollers[name]
+    except KeyError:
+        raise ValueError("poller %r is not available on this platform (%s)"
+                         % (name, ', '.join(sorted(pollers))))
+
+# timers and timeouts must not follow steps of the wall clock
+monotonic = getattr(time, 'monotonic', time.time)
+
+class timer:
+    """Callback scheduled on a timer_wheel, cancel() removes it."""
+
+    __slots__ = ('when', 'tick', 'callback', 'args', 'wheel')
+
+    def __init__(self, when, tick, callback, args, wheel):
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.wheel = wheel
+
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel._remove(self)
+
+class timer_wheel:
+    """Hashed timing wheel for the timeouts of the loop.
+
+    A timer due at time `when` lives in slot int(when / resolution) modulo
+    the number of slots, so call_at() and cancel() cost O(1) no matter how
+    many connections have a timeout pending.  Timers more than one turn of
+    the wheel ahead wait in their slot until their turn comes.  The earliest
+    due time is kept as a lower bound, timeout() turns it into the timeout
+    of the next poll and run() fires the timers which are due.  Times are
+    read from monotonic(), the clock of call_at() as well.
+    """
+
+    def __init__(self, resolution=0.1, slots=1024):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.count = 0
+        # first tick not processed by run() yet
+        self.tick = int(monotonic() / resolution)
+        # no timer is due before this time
+        self.earliest = None
+
+    def __len__(self):
+        return self.count
+
+    def call_at(self, when, callback, *args):
+        """runs callback(*args) from run() once monotonic() reaches when"""
+        tick = max(int(when / self.resolution), self.tick)
+        entry = timer(when, tick, callback, args, self)
+        self.slots[tick % len(self.slots)].add(entry)
+        self.count += 1
+        if self.earliest is None or when < self.earliest:
+            self.earliest = when
+        return entry
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def _remove(self, entry):
+        self.slots[entry.tick % len(self.slots)].discard(entry)
+        entry.wheel = None
+        self.count -= 1
+        if not self.count:
+            self.earliest = None
+
+    def timeout(self, default=None, now=None):
+        """returns seconds until the next timer is due, at most default"""
+        if self.earliest is None:
+            return default
+        if now is None:
+            now = monotonic()
+        delay = max(self.earliest - now, 0.0)
+        if default is None or delay < default:
+            return delay
+        return default
+
+    def run(self, now=None):
+        """fires timers due at now, returns their number"""
+        if self.earliest is None:
+            return 0
+        if now is None:
+            now = monotonic()
+        if now < self.earliest:
+            return 0
+        slots = self.slots
+        size = len(slots)
+        last = int(now / self.resolution)
+        due = []
+        # after an idle period longer than one turn every slot is visited once
+        for tick in range(max(self.tick, last - size + 1), last + 1):
+            for entry in slots[tick % size]:
+                if entry.tick <= last and entry.when <= now:
+                    due.append(entry)
+        self.tick = last
+        due.sort(key=lambda entry: entry.when)
+        for entry in due:
+            self._remove(entry)
+        self._find_earliest()
+        for entry in due:
+            try:
+                entry.callback(*entry.args)
+            except _reraised_exceptions:
+                raise
+            except:
+                nil, t, v, tbinfo = compact_traceback()
+                sys.stderr.write('uncaptured python exception in timer (%s:%s %s)\n' % (t, v, tbinfo))
+        return len(due)
+
+    def _find_earliest(self):
+        self.earliest = None
+        if not self.count:
+            return
+        slots = self.slots
+        size = len(slots)
+        # the first slot with a timer of the current turn holds the earliest one
+        for tick in range(self.tick, self.tick + size):
+            turn = [entry.when for entry in slots[tick % size] if entry.tick == tick]
+            if turn:
+                self.earliest = min(turn)
+                return
+        self.earliest = min(entry.when for slot in slots for entry in slot)
+
 def loop(timeout=30.0, use_poll=False, map=None, count=None,
-         poller=select_poller):
+         poller=None, timers=None):
+    """Polls the sockets of map until it is empty (or count times).  With a
+    timer_wheel in timers the poll waits at most until its next timer is due
+    and the due timers run after every poll."""
     if map is None:
         map = socket_map
-    # code which grants backward compatibility with "use_poll"
-    # argument which should no longer be used in favor of
-    # "poller"
-    if use_poll and hasattr(select, 'poll'):
-        poller = poll_poller
-    else:
-        poller = select_poller
+    if poller is None:
+        # code which grants backward compatibility with "use_poll"
+        # argument which should no longer be used in favor of
+        # "poller"
+        if use_poll and hasattr(select, 'poll'):
+            poller = poll_poller
+        else:
+            poller = select_poller
+    elif not callable(poller):
+        poller = get_poller(poller)
 
     if count is None:
         while map:
-            poller(timeout, map)
+            if timers is None:
+                poller(timeout, map)
+            else:
+                poller(timers.timeout(timeout), map)
+                timers.run()
     else:
         while map and count > 0:
-            poller(timeout, map)
+            if timers is None:
+                poller(timeout, map)
+            else:
+                poller(timers.timeout(timeout), map)
+                timers.run()
             count = count - 1
 
 class dispatcher:
@@ -345,6 +644,9 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        reactor = _reactors.get(id(map))
+        if reactor is not None:
+            reactor.touch(self._fileno)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -352,9 +654,25 @@ class dispatcher:
             map = self._map
         if fd in map:
             #self.log_info('closing channel %d:%s' % (fd, self))
+            reactor = _reactors.get(id(map))
+            if reactor is not None:
+                reactor.forget(fd)
             del map[fd]
         self._fileno = None
 
+    def update_interest(self):
+        # readable()/writable() may have changed outside of this
+        # dispatcher's own event handlers; persistent pollers only
+        # re-evaluate descriptors they were told about
+        reactor = _reactors.get(id(self._map))
+        if reactor is not None and self._fileno is not None:
+            reactor.touch(self._fileno)
+
+    def _would_block(self, flags):
+        reactor = _reactors.get(id(self._map))
+        if reactor is not None:
+            reactor.would_block(self._fileno, flags)
+
     def create_socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM):
         self.family_and_type = family, type
         sock = socket.socket(family, type)
@@ -425,7 +743,10 @@ class dispatcher:
         except TypeError:
             return None
         except socket.error as why:
-            if why.args[0] in (EWOULDBLOCK, ECONNABORTED, EAGAIN):
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self._would_block(_POLLIN)
+                return None
+            elif why.args[0] == ECONNABORTED:
                 return None
             else:
                 raise
@@ -435,9 +756,29 @@ class dispatcher:
     def send(self, data):
         try:
             result = self.socket.send(data)
+            if result < len(data):
+                self._would_block(_POLLOUT)
+            return result
+        except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self._would_block(_POLLOUT)
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
+    def sendmsg(self, buffers):
+        """sends buffers by one scatter/gather call, returns bytes sent"""
+        try:
+            result = self.socket.sendmsg(buffers)
+            if result < sum(len(data) for data in buffers):
+                self._would_block(_POLLOUT)
             return result
         except socket.error as why:
-            if why.args[0] == EWOULDBLOCK:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self._would_block(_POLLOUT)
                 return 0
             elif why.args[0] in _DISCONNECTED:
                 self.handle_close()
@@ -454,10 +795,15 @@ class dispatcher:
                 self.handle_close()
                 return b''
             else:
+                if len(data) < buffer_size:
+                    self._would_block(_POLLIN)
                 return data
         except socket.error as why:
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self._would_block(_POLLIN)
+                return b''
             # winsock sometimes raises ENOTCONN
-            if why.args[0] in _DISCONNECTED:
+            elif why.args[0] in _DISCONNECTED:
                 self.handle_close()
                 return b''
             else:
@@ -659,6 +1005,9 @@ def close_all(map=None, ignore_all=False):
             if not ignore_all:
                 raise
     map.clear()
+    reactor = _reactors.get(id(map))
+    if reactor is not None:
+        reactor.close()
 
 # Asynchronous File I/O:
 #
@@ -725,4 +1074,106 @@ if os.name == 'posix':
         def set_file(self, fd):
             self.socket = file_wrapper(fd)
             self._fileno = self.socket.fileno()
-            self.add_channel()
\ No newline at end of file
+            self.add_channel()
+
+    class waker(file_dispatcher):
+        """Read end of a pipe watched by the loop.  Any thread may queue a
+        callback with call_soon_threadsafe(), which also writes a byte to the
+        pipe; the loop wakes up and runs the queued callbacks in its thread.
+        """
+
+        def __init__(self, map=None):
+            read_fd, self.write_fd = os.pipe()
+            file_dispatcher.__init__(self, read_fd, map)
+            os.close(read_fd)
+            flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL, 0)
+            fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.callbacks = deque()
+
+        def writable(self):
+            return False
+
+        def call_soon_threadsafe(self, callback, *args):
+            self.callbacks.append((callback, args))
+            try:
+                os.write(self.write_fd, b'x')
+            except OSError as why:
+                # a full pipe already guarantees a wakeup
+                if why.args[0] not in (EAGAIN, EWOULDBLOCK):
+                    raise
+
+        def handle_read(self):
+            while True:
+                try:
+                    if len(os.read(self._fileno, 4096)) < 4096:
+                        break
+                except OSError as why:
+                    if why.args[0] in (EAGAIN, EWOULDBLOCK):
+                        break
+                    raise
+            self._would_block(_POLLIN)
+            while self.callbacks:
+                callback, args = self.callbacks.popleft()
+                try:
+                    callback(*args)
+                except _reraised_exceptions:
+                    raise
+                except:
+                    self.handle_error()
+
+        def handle_error(self):
+            # a failed callback must not close the pipe other threads write to
+            nil, t, v, tbinfo = compact_traceback()
+            self.log_info('uncaptured python exception in callback (%s:%s %s)'
+                          % (t, v, tbinfo), 'error')
+
+        def close(self):
+            file_dispatcher.close(self)
+            os.close(self.write_fd)
+
+
+class thread_pool:
+    """Worker threads for blocking calls.  submit() queues function(*args),
+    its outcome is handed back as callback(result, error) through
+    call_soon_threadsafe, the method of a waker (or of an asyncio loop), so
+    callbacks run in the thread of the event loop.  At most max_jobs calls
+    wait for a thread: when the queue is full submit() makes the call itself,
+    which holds the loop back until the threads catch up.
+    """
+
+    def __init__(self, threads, call_soon_threadsafe, max_jobs=1024):
+        self.call_soon_threadsafe = call_soon_threadsafe
+        self.jobs = queue.Queue(max_jobs)
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, args, callback):
+        try:
+            self.jobs.put_nowait((function, args, callback))
+        except queue.Full:
+            # the callback still runs later from the loop, as it does for the threads
+            self._run(function, args, callback)
+
+    def _run(self, function, args, callback):
+        try:
+            result = function(*args)
+        except Exception as error:
+            self.call_soon_threadsafe(callback, None, error)
+        else:
+            self.call_soon_threadsafe(callback, result, None)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            self._run(*job)
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        self.threads = []
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Runs httptest.py against httpd.py on every backend.
+
+Each configuration starts the server on a copy of the httptest fixtures:
+asyncore and asyncio, with the file cache and without it, so files are sent
+by the producers of the backend (loop.sendfile() of asyncio, chunks written
+to the transport on uvloop, which is used whenever it is installed).
+"""
+from __future__ import print_function
+
+import getopt
+import os
+import subprocess
+import sys
+
+from httpbench import HERE, start_server, stop_server
+
+# httptest.py expects POST to be refused
+COMMON_ARGS = ["--forbidden_methods=POST"]
+
+# name, arguments of httpd.py
+CONFIGURATIONS = [
+    ("asyncore", ["--backend=asyncore"]),
+    ("asyncore_uncached", ["--backend=asyncore", "--cache_size=0"]),
+    ("asyncio", ["--backend=asyncio"]),
+    ("asyncio_uncached", ["--backend=asyncio", "--cache_size=0"]),
+]
+
+
+def has_uvloop(python):
+    return subprocess.call([python, "-c", "import uvloop"], stderr=open(os.devnull, "w")) == 0
+
+
+def run_configuration(configuration, python, test_python, port, workers, server_args):
+    """returns True if httptest.py passed against the server started with the configuration"""
+    name, args = configuration
+    args = COMMON_ARGS + args + server_args
+    print("== %s: %s" % (name, " ".join(args)))
+    sys.stdout.flush()
+    server, root = start_server(python, port, workers, args)
+    try:
+        env = dict(os.environ, HTTPTEST_PORT=str(port))
+        return subprocess.call([test_python, os.path.join(HERE, "httptest.py")], env=env) == 0
+    finally:
+        stop_server(server, root)
+
+
+def help():
+    print("Runs httptest.py against httpd.py on asyncore and asyncio, with and without the file cache")
+    print("Parameters description:")
+    print("-h (--help) - print help")
+    print("-p (--port) - port for the tested server. Default is 8091")
+    print("-w (--workers) - number of server workers. Default is 2")
+    print("--python - interpreter for the server. Default is python3")
+    print("--test_python - interpreter for httptest.py, which needs python 2. Default is python2")
+    print("--uvloop - fail unless the server interpreter has uvloop, so asyncio runs on it")
+    print("--configurations - comma separated names of configurations to run (%s). Default is all" %
+          ", ".join(configuration[0] for configuration in CONFIGURATIONS))
+    print("--server_args - extra arguments for httpd.py, like \"--poller=epoll_et\"")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hp:w:', ['help', 'port=', 'workers=', 'python=', 'test_python=',
+                                                          'uvloop', 'configurations=', 'server_args='])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+
+    port = 8091
+    workers = 2
+    python = "python3"
+    test_python = "python2"
+    uvloop = False
+    names = [configuration[0] for configuration in CONFIGURATIONS]
+    server_args = []
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            help()
+            sys.exit(0)
+        elif opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt == '--python':
+            python = arg
+        elif opt == '--test_python':
+            test_python = arg
+        elif opt == '--uvloop':
+            uvloop = True
+        elif opt == '--configurations':
+            names = arg.split(',')
+        elif opt == '--server_args':
+            server_args = arg.split()
+
+    unknown = set(names) - set(configuration[0] for configuration in CONFIGURATIONS)
+    if unknown:
+        print("unknown configurations: %s" % ", ".join(sorted(unknown)), file=sys.stderr)
+        sys.exit(2)
+    if has_uvloop(python):
+        print("asyncio runs on uvloop")
+    elif uvloop:
+        print("uvloop is not installed for %s" % python, file=sys.stderr)
+        sys.exit(2)
+
+    failed = [configuration[0] for configuration in CONFIGURATIONS if configuration[0] in names and
+              not run_configuration(configuration, python, test_python, port, workers, server_args)]
+    if failed:
+        print("failed: %s" % ", ".join(failed))
+        sys.exit(1)
+    print("all configurations passed")
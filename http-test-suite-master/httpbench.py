@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generation benchmark for httpd.py.
+
+Starts the server on a temporary copy of the httptest fixtures, runs every
+scenario against it for a fixed time with a pool of client processes and
+prints RPS, latency percentiles and CPU time of each server worker as JSON.
+"""
+from __future__ import print_function
+
+import getopt
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+timer = getattr(time, "perf_counter", time.time)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTTPD = os.path.join(os.path.dirname(HERE), "httpd.py")
+
+# name, method, path, keep-alive, concurrency
+SCENARIOS = [
+    ("small_file", "GET", "/httptest/dir2/page.html", True, 50),
+    ("small_file_close", "GET", "/httptest/dir2/page.html", False, 50),
+    ("large_file", "GET", "/httptest/wikipedia_russia.html", True, 10),
+    ("not_found", "GET", "/httptest/smdklcdsmvdfjnvdfjvdfvdfvdsfssdmfdsdfsd.html", True, 50),
+    ("head", "HEAD", "/httptest/splash.css", True, 50),
+    ("high_concurrency", "GET", "/httptest/dir2/page.html", True, 1000),
+]
+
+
+def read_response(sock, buf, head):
+    """reads one response from sock, returns (status, connection closed by server, leftover bytes)"""
+    while b"\r\n\r\n" not in buf:
+        data = sock.recv(65536)
+        if not data:
+            raise ValueError("connection closed before response head")
+        buf += data
+    head_data, _, buf = buf.partition(b"\r\n\r\n")
+    lines = head_data.split(b"\r\n")
+    status = int(lines[0].split(b" ")[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+    closed = headers.get(b"connection") == b"close" or lines[0].startswith(b"HTTP/1.0") and \
+        headers.get(b"connection") != b"keep-alive"
+    if head:
+        return status, closed, buf
+    length = headers.get(b"content-length")
+    if length is None:
+        while sock.recv(65536):
+            pass
+        return status, True, b""
+    length = int(length)
+    while len(buf) < length:
+        data = sock.recv(max(65536, length - len(buf)))
+        if not data:
+            raise ValueError("connection closed in the middle of body")
+        buf += data
+    return status, closed, buf[length:]
+
+
+def client_thread(address, method, path, keep_alive, deadline, latencies, statuses):
+    request = ("%s %s HTTP/1.1\r\nHost: %s\r\n%s\r\n" % (
+        method, path, address[0], "" if keep_alive else "Connection: close\r\n")).encode("ascii")
+    sock = None
+    buf = b""
+    while time.time() < deadline:
+        started = timer()
+        try:
+            if sock is None:
+                sock = socket.create_connection(address, timeout=10)
+                buf = b""
+            sock.sendall(request)
+            status, closed, buf = read_response(sock, buf, method == "HEAD")
+        except (socket.error, ValueError):
+            statuses["error"] += 1
+            if sock is not None:
+                sock.close()
+            sock = None
+            continue
+        latencies.append(timer() - started)
+        statuses[str(status)] += 1
+        if closed or not keep_alive:
+            sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+
+
+def client_process(args):
+    address, method, path, keep_alive, threads, deadline = args
+    latencies = []
+    statuses = defaultdict(int)
+    workers = [threading.Thread(target=client_thread,
+                                args=(address, method, path, keep_alive, deadline, latencies, statuses))
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, dict(statuses)
+
+
+def worker_pids(master_pid):
+    """returns pids of server worker processes (children of master_pid)"""
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def cpu_seconds(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except (IOError, OSError):
+        return None
+    # utime and stime, fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_scenario(scenario, address, server_pid, duration, clients):
+    name, method, path, keep_alive, concurrency = scenario
+    processes = min(clients, concurrency)
+    threads = [concurrency // processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+    workers = worker_pids(server_pid) or [server_pid]
+    cpu_before = dict((pid, cpu_seconds(pid)) for pid in workers)
+
+    started = time.time()
+    deadline = started + duration
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(client_process, [(address, method, path, keep_alive, n, deadline) for n in threads])
+    finally:
+        pool.terminate()
+    elapsed = time.time() - started
+
+    latencies = []
+    statuses = defaultdict(int)
+    for process_latencies, process_statuses in results:
+        latencies.extend(process_latencies)
+        for status, count in process_statuses.items():
+            statuses[status] += count
+    latencies.sort()
+
+    workers_cpu = []
+    for pid in workers:
+        after = cpu_seconds(pid)
+        if after is None or cpu_before[pid] is None:
+            continue
+        used = after - cpu_before[pid]
+        workers_cpu.append({"pid": pid, "cpu_seconds": round(used, 3), "cpu_percent": round(100 * used / elapsed, 1)})
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "name": name, "method": method, "path": path, "keep_alive": keep_alive,
+        "concurrency": concurrency, "duration": round(elapsed, 3),
+        "requests": len(latencies), "errors": statuses.pop("error", 0), "statuses": dict(statuses),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.5)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "workers_cpu": workers_cpu,
+    }
+
+
+def start_server(python, port, workers, server_args):
+    """starts httpd.py on a temporary copy of httptest fixtures, returns (process, document root)"""
+    root = tempfile.mkdtemp(prefix="httpbench")
+    shutil.copytree(os.path.join(HERE, "httptest"), os.path.join(root, "httptest"))
+    command = [python, HTTPD, "-p", str(port), "-r", root, "-w", str(workers),
+               "-l", os.path.join(root, "httpd.log")] + server_args
+    process = subprocess.Popen(command, preexec_fn=os.setsid)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except socket.error:
+            if process.poll() is not None:
+                raise RuntimeError("server exited with code %s" % process.returncode)
+            time.sleep(0.1)
+    else:
+        raise RuntimeError("server did not start listening on port %d" % port)
+    # let every worker open its listening socket
+    time.sleep(0.5)
+    return process, root
+
+
+def stop_server(process, root):
+    try:
+        os.killpg(process.pid, signal.SIGINT)
+        for _ in range(30):
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    except OSError:
+        pass
+    shutil.rmtree(root, ignore_errors=True)
+
+
+def help():
+    print("Benchmark of httpd.py: starts the server on a copy of httptest fixtures and reports JSON with RPS, "
+          "p50/p99/p999 latency and per-worker CPU for every scenario")
+    print("Parameters description:")
+    print("-h (--help) - print help")
+    print("-p (--port) - port for the benchmarked server. Default is 8090")
+    print("-w (--workers) - number of server workers. Default is 2")
+    print("-d (--duration) - seconds each scenario runs. Default is 5")
+    print("-c (--clients) - number of client processes. Default is number of CPUs")
+    print("-o (--output) - file for JSON report. Default is console output")
+    print("--python - interpreter for the server. Default is the one running the benchmark")
+    print("--scenarios - comma separated names of scenarios to run (%s). Default is all" %
+          ", ".join(scenario[0] for scenario in SCENARIOS))
+    print("--server_args - extra arguments for httpd.py, like \"--poller=epoll_et --cache_size=0\"")
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hp:w:d:c:o:', ['help', 'port=', 'workers=', 'duration=',
+                                                                   'clients=', 'output=', 'python=',
+                                                                   'scenarios=', 'server_args='])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+
+    port = 8090
+    workers = 2
+    duration = 5.0
+    clients = multiprocessing.cpu_count()
+    output = None
+    python = sys.executable
+    names = [scenario[0] for scenario in SCENARIOS]
+    server_args = []
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            help()
+            sys.exit(0)
+        elif opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-d', '--duration'):
+            duration = float(arg)
+        elif opt in ('-c', '--clients'):
+            clients = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt == '--python':
+            python = arg
+        elif opt == '--scenarios':
+            names = arg.split(',')
+        elif opt == '--server_args':
+            server_args = arg.split()
+
+    unknown = set(names) - set(scenario[0] for scenario in SCENARIOS)
+    if unknown:
+        print("unknown scenarios: %s" % ", ".join(sorted(unknown)), file=sys.stderr)
+        sys.exit(2)
+
+    server, root = start_server(python, port, workers, server_args)
+    try:
+        report = {
+            "server": {"python": python, "workers": workers, "args": server_args},
+            "scenarios": [run_scenario(scenario, ("127.0.0.1", port), server.pid, duration, clients)
+                          for scenario in SCENARIOS if scenario[0] in names],
+        }
+    finally:
+        stop_server(server, root)
+
+    if output:
+        with open(output, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
+import os
 import re
 import socket
+import sys
+import time
 import httplib
 import unittest
 
 class HttpServer(unittest.TestCase):
   host = "localhost"
-  port = 8080
+  port = int(os.environ.get("HTTPTEST_PORT", 8080))
 
   def setUp(self):
     self.conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
@@ -266,6 +269,184 @@ class HttpServer(unittest.TestCase):
     self.assertEqual(len(data), 35344)
     self.assertEqual(ctype, "application/x-shockwave-flash")
 
+  def test_pipelined_requests(self):
+    """two pipelined requests on one connection"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(10)
+    s.connect((self.host, self.port))
+    s.sendall("GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+              "GET /httptest/text..txt HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    data = ""
+    while 1:
+      buf = s.recv(1024)
+      if not buf: break
+      data += buf
+    s.close()
+
+    responses = []
+    while data:
+      self.assertTrue(data.find("\r\n\r\n") > 0, "no empty line with CRLF found")
+      (head, data) = data.split("\r\n\r\n", 1)
+      headers = head.split("\r\n")
+      (proto, code, status) = headers.pop(0).split(" ", 2)
+      h = {}
+      for v in headers:
+        (name, value) = re.split('\s*:\s*', v, 1)
+        h[name.lower()] = value
+      length = int(h['content-length'])
+      responses.append((int(code), data[:length]))
+      data = data[length:]
+    self.assertEqual(responses, [(200, "<html><body>Page Sample</body></html>\n"), (200, "hello")])
+
+  def get_raw(self, path, headers):
+    """returns status code, headers and body of HTTP/1.0 GET read until the server closes connection"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(10)
+    s.connect((self.host, self.port))
+    s.sendall("GET %s HTTP/1.0\r\n%s\r\n" % (path, "".join("%s: %s\r\n" % item for item in headers.items())))
+    data = ""
+    while 1:
+      buf = s.recv(1024)
+      if not buf: break
+      data += buf
+    s.close()
+    (head, body) = data.split("\r\n\r\n", 1)
+    headers = head.split("\r\n")
+    (proto, code, status) = headers.pop(0).split(" ", 2)
+    h = {}
+    for v in headers:
+      (name, value) = re.split('\s*:\s*', v, 1)
+      h[name.lower()] = value
+    return int(code), h, body
+
+  def test_if_none_match(self):
+    """If-None-Match with current ETag returns 304 without body"""
+    self.conn.request("GET", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    r.read()
+    etag = r.getheader("ETag")
+    self.assertIsNotNone(etag)
+    (code, headers, body) = self.get_raw("/httptest/dir2/page.html", {"If-None-Match": etag})
+    self.assertEqual(code, 304)
+    self.assertEqual(headers.get("etag"), etag)
+    self.assertEqual(body, "")
+    (code, headers, body) = self.get_raw("/httptest/dir2/page.html", {"If-None-Match": '"0-0-0", ' + etag})
+    self.assertEqual(code, 304)
+    self.assertEqual(body, "")
+    (code, headers, body) = self.get_raw("/httptest/dir2/page.html", {"If-None-Match": '"0-0-0"'})
+    self.assertEqual(code, 200)
+    self.assertEqual(len(body), 38)
+
+  def test_if_modified_since(self):
+    """If-Modified-Since not older than file returns 304 without body"""
+    self.conn.request("GET", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    r.read()
+    last_modified = r.getheader("Last-Modified")
+    self.assertIsNotNone(last_modified)
+    (code, headers, body) = self.get_raw("/httptest/dir2/page.html", {"If-Modified-Since": last_modified})
+    self.assertEqual(code, 304)
+    self.assertEqual(body, "")
+    (code, headers, body) = self.get_raw("/httptest/dir2/page.html",
+                                         {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    self.assertEqual(code, 200)
+    self.assertEqual(len(body), 38)
+
+  def test_if_none_match_variant(self):
+    """If-None-Match with ETag of gzip variant returns 304 with that ETag"""
+    # the variant is compressed in background, the file is sent as is until it is ready
+    for _ in range(50):
+      self.conn.request("GET", "/httptest/wikipedia_russia.html", headers={"Accept-Encoding": "gzip"})
+      r = self.conn.getresponse()
+      r.read()
+      if r.getheader("Content-Encoding") == "gzip":
+        break
+      time.sleep(0.1)
+    self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+    etag = r.getheader("ETag")
+    (code, headers, body) = self.get_raw("/httptest/wikipedia_russia.html",
+                                         {"If-None-Match": etag, "Accept-Encoding": "gzip"})
+    self.assertEqual(code, 304)
+    self.assertEqual(headers.get("etag"), etag)
+    self.assertEqual(headers.get("vary"), "Accept-Encoding")
+    self.assertEqual(body, "")
+
+  def test_range(self):
+    """byte range of file"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=6-11"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(r.getheader("Content-Range"), "bytes 6-11/38")
+    self.assertEqual(int(r.getheader("Content-Length")), 6)
+    self.assertEqual(data, "<body>")
+
+  def test_suffix_range(self):
+    """suffix byte range of file"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=-8"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(r.getheader("Content-Range"), "bytes 30-37/38")
+    self.assertEqual(data, "</html>\n")
+
+  def test_unsatisfiable_range(self):
+    """range beyond the end of file returns 416"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=38-"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 416)
+    self.assertEqual(r.getheader("Content-Range"), "bytes */38")
+    self.assertEqual(data, "")
+
+  def test_multipart_ranges(self):
+    """several byte ranges in multipart/byteranges"""
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=0-5,-8"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    ctype = r.getheader("Content-Type")
+    self.assertTrue(ctype.startswith("multipart/byteranges; boundary="))
+    boundary = ctype.split("boundary=", 1)[1]
+    self.assertEqual(int(r.getheader("Content-Length")), len(data))
+    parts = data.split("\r\n--" + boundary)
+    self.assertEqual(parts[0], "")
+    self.assertEqual(parts[-1], "--\r\n")
+    self.assertEqual(len(parts), 4)
+    (head, body) = parts[1].split("\r\n\r\n", 1)
+    self.assertIn("Content-Range: bytes 0-5/38", head)
+    self.assertEqual(body, "<html>")
+    (head, body) = parts[2].split("\r\n\r\n", 1)
+    self.assertIn("Content-Range: bytes 30-37/38", head)
+    self.assertEqual(body, "</html>\n")
+
+  def test_if_range_mismatch(self):
+    """If-Range naming another version returns whole file"""
+    self.conn.request("GET", "/httptest/dir2/page.html",
+                      headers={"Range": "bytes=0-5", "If-Range": '"0-0-0"'})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(data, "<html><body>Page Sample</body></html>\n")
+    self.conn.request("GET", "/httptest/dir2/page.html",
+                      headers={"Range": "bytes=0-5", "If-Range": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 200)
+    self.assertEqual(len(data), 38)
+
+  def test_if_range_match(self):
+    """If-Range naming current version returns range"""
+    self.conn.request("GET", "/httptest/dir2/page.html")
+    r = self.conn.getresponse()
+    r.read()
+    etag = r.getheader("ETag")
+    self.conn.request("GET", "/httptest/dir2/page.html", headers={"Range": "bytes=0-5", "If-Range": etag})
+    r = self.conn.getresponse()
+    data = r.read()
+    self.assertEqual(int(r.status), 206)
+    self.assertEqual(data, "<html>")
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)
@@ -280,5 +461,6 @@ class NewRunner(unittest.TextTestRunner):
   resultclass = NewResult
 
 runner = NewRunner(verbosity=2)
-runner.run(suite)
+result = runner.run(suite)
+sys.exit(not result.wasSuccessful())
 
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of httpd.py helpers which need no running server, on python 2 and 3."""
+import io
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncore_epoll
+import httpd
+import metrics
+import shmcache
+
+
+class MetricsBuckets(unittest.TestCase):
+
+  def test_zero(self):
+    """zero duration in the first bucket"""
+    self.assertEqual(metrics.bucket(0.0), 0)
+
+  def test_negative(self):
+    """negative duration in the first bucket"""
+    self.assertEqual(metrics.bucket(-1.0), 0)
+    self.assertEqual(metrics.bucket(-0.6), 0)
+
+  def test_below_first_bound(self):
+    """durations up to the first bound in the first bucket"""
+    self.assertEqual(metrics.bucket(1e-9), 0)
+    self.assertEqual(metrics.bucket(metrics.BOUNDS[0]), 0)
+    self.assertEqual(metrics.bucket(metrics.BOUNDS[0] * 1.001), 1)
+
+  def test_bounds(self):
+    """every bound closes its bucket"""
+    for index, bound in enumerate(metrics.BOUNDS):
+      self.assertEqual(metrics.bucket(bound), index)
+      self.assertEqual(metrics.bucket(bound * 1.001), index + 1)
+
+  def test_overflow(self):
+    """durations above the last bound in the +Inf bucket"""
+    last = len(metrics.BOUNDS)
+    self.assertEqual(metrics.bucket(metrics.BOUNDS[-1] * 2), last)
+    self.assertEqual(metrics.bucket(1e9), last)
+
+  def test_clock(self):
+    """clock does not go back"""
+    first = metrics.clock()
+    self.assertGreaterEqual(metrics.clock() - first, 0.0)
+
+
+class MetricsRender(unittest.TestCase):
+
+  def test_omitted(self):
+    """omitted counters are left out of the status page"""
+    shared = metrics.Metrics(1, generations=1, omitted=(metrics.POLLER_WAKEUPS,))
+    text = shared.render()
+    self.assertNotIn("httpd_poller_wakeups_total", text)
+    self.assertIn("httpd_requests_total 0\n", text)
+    self.assertIn("httpd_poller_wakeups_total 0\n", metrics.Metrics(1, generations=1).render())
+
+
+class RequestParser(unittest.TestCase):
+
+  head = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\nAccept: */*"
+
+  def test_whole_head(self):
+    """head received at once"""
+    parser = httpd.RequestParser()
+    parser.feed(self.head + b"\r\n\r\n")
+    self.assertEqual(parser.next_head(), self.head)
+    self.assertEqual(parser.pending(), 0)
+    self.assertIsNone(parser.next_head())
+
+  def test_split_head(self):
+    """head split at every byte boundary"""
+    data = self.head + b"\r\n\r\n"
+    for split in range(1, len(data)):
+      parser = httpd.RequestParser()
+      parser.feed(data[:split])
+      self.assertIsNone(parser.next_head())
+      parser.feed(data[split:])
+      self.assertEqual(parser.next_head(), self.head)
+
+  def test_byte_by_byte(self):
+    """head received one byte at a time"""
+    data = self.head + b"\r\n\r\n"
+    parser = httpd.RequestParser()
+    for index in range(len(data) - 1):
+      parser.feed(data[index:index + 1])
+      self.assertIsNone(parser.next_head())
+    parser.feed(data[-1:])
+    self.assertEqual(parser.next_head(), self.head)
+
+  def test_pipelined(self):
+    """pipelined heads and body bytes after a head are kept"""
+    parser = httpd.RequestParser()
+    parser.feed(self.head + b"\r\n\r\nbody" + self.head + b"\r\n\r\n")
+    self.assertEqual(parser.next_head(), self.head)
+    self.assertEqual(parser.take(4), b"body")
+    self.assertEqual(parser.next_head(), self.head)
+    self.assertEqual(parser.pending(), 0)
+
+  def test_head_size_limit(self):
+    """head longer than max_head_size is refused with 431"""
+    parser = httpd.RequestParser(max_head_size=64)
+    parser.feed(b"GET / HTTP/1.1\r\nX-Long: " + b"x" * 64)
+    with self.assertRaises(httpd.RequestError) as raised:
+      parser.next_head()
+    self.assertEqual(raised.exception.status_line[:3], "431")
+
+  def test_complete_head_over_limit(self):
+    """complete head longer than max_head_size is refused with 431"""
+    parser = httpd.RequestParser(max_head_size=64)
+    parser.feed(b"GET / HTTP/1.1\r\nX-Long: " + b"x" * 64 + b"\r\n\r\n")
+    with self.assertRaises(httpd.RequestError) as raised:
+      parser.next_head()
+    self.assertEqual(raised.exception.status_line[:3], "431")
+
+  def test_head_at_limit(self):
+    """head of max_head_size bytes is accepted"""
+    head = b"GET / HTTP/1.1\r\nX: " + b"x" * 45
+    self.assertEqual(len(head), 64)
+    parser = httpd.RequestParser(max_head_size=64)
+    parser.feed(head[:40])
+    self.assertIsNone(parser.next_head())
+    parser.feed(head[40:] + b"\r\n\r\n")
+    self.assertEqual(parser.next_head(), head)
+
+
+class RequestBody(unittest.TestCase):
+
+  def receive(self, data, max_size=1024, length=None, step=None):
+    """returns body decoded from data fed to the parser step bytes at a time (all at once by default)
+    and True if it is complete"""
+    parser = httpd.RequestParser()
+    sink = io.BytesIO()
+    body = httpd.RequestBody(None, sink, max_size, length)
+    step = step or len(data)
+    done = False
+    for start in range(0, len(data), step):
+      parser.feed(data[start:start + step])
+      done = body.receive(parser)
+    return sink.getvalue(), done
+
+  def assertRefused(self, data, status, max_size=1024):
+    with self.assertRaises(httpd.RequestError) as raised:
+      self.receive(data, max_size)
+    self.assertEqual(raised.exception.status_line[:3], status)
+
+  def test_content_length(self):
+    """body of Content-Length bytes"""
+    self.assertEqual(self.receive(b"hello", length=5), (b"hello", True))
+    self.assertEqual(self.receive(b"hel", length=5), (b"hel", False))
+
+  def test_chunked(self):
+    """chunked body"""
+    data = b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n"
+    self.assertEqual(self.receive(data), (b"hello world", True))
+
+  def test_chunked_split(self):
+    """chunked body received one byte at a time"""
+    data = b"5\r\nhello\r\nA\r\n0123456789\r\n0\r\n\r\n"
+    self.assertEqual(self.receive(data, step=1), (b"hello0123456789", True))
+
+  def test_incomplete(self):
+    """chunked body without the last chunk is not complete"""
+    self.assertEqual(self.receive(b"5\r\nhello\r\n"), (b"hello", False))
+    self.assertEqual(self.receive(b"5\r\nhello\r\n0\r\n"), (b"hello", False))
+
+  def test_chunk_extensions(self):
+    """chunk extensions are ignored"""
+    data = b"5;name=value\r\nhello\r\n0;last\r\n\r\n"
+    self.assertEqual(self.receive(data), (b"hello", True))
+
+  def test_trailers(self):
+    """trailer fields after the last chunk are skipped"""
+    data = b"5\r\nhello\r\n0\r\nExpires: never\r\nX-Checksum: 1\r\n\r\n"
+    self.assertEqual(self.receive(data), (b"hello", True))
+    self.assertEqual(self.receive(data, step=3), (b"hello", True))
+
+  def test_bad_chunk_size(self):
+    """malformed chunk size is refused with 400"""
+    self.assertRefused(b"5x\r\nhello\r\n0\r\n\r\n", "400")
+    self.assertRefused(b"-5\r\nhello\r\n0\r\n\r\n", "400")
+    self.assertRefused(b"\r\nhello\r\n0\r\n\r\n", "400")
+    self.assertRefused(b"1" * 2048, "400")
+
+  def test_missing_chunk_end(self):
+    """chunk data longer than its size is refused with 400"""
+    self.assertRefused(b"5\r\nhello!\r\n0\r\n\r\n", "400")
+
+  def test_over_limit(self):
+    """body longer than max_size is refused with 413"""
+    self.assertRefused(b"5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n", "413", max_size=10)
+    self.assertRefused(b"FFFFFFFF\r\n", "413")
+    self.assertEqual(self.receive(b"5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n", max_size=10), (b"helloworld", True))
+
+
+class ParseRange(unittest.TestCase):
+
+  def test_ranges(self):
+    """first-last, open and suffix ranges"""
+    self.assertEqual(httpd.parse_range("bytes=0-9", 100), [(0, 9)])
+    self.assertEqual(httpd.parse_range("bytes=90-", 100), [(90, 99)])
+    self.assertEqual(httpd.parse_range("bytes=-5", 100), [(95, 99)])
+    self.assertEqual(httpd.parse_range("bytes=-500", 100), [(0, 99)])
+    self.assertEqual(httpd.parse_range("bytes=0-0, 98-200", 100), [(0, 0), (98, 99)])
+
+  def test_unsatisfiable(self):
+    """ranges beyond the end are dropped"""
+    self.assertEqual(httpd.parse_range("bytes=100-", 100), [])
+    self.assertEqual(httpd.parse_range("bytes=-0", 100), [])
+
+  def test_empty_file(self):
+    """no range of an empty file is satisfiable"""
+    self.assertEqual(httpd.parse_range("bytes=-5", 0), [])
+    self.assertEqual(httpd.parse_range("bytes=0-", 0), [])
+    self.assertEqual(httpd.parse_range("bytes=0-0", 0), [])
+    self.assertEqual(httpd.parse_range("bytes=-5,0-", 0), [])
+
+  def test_malformed(self):
+    """malformed header or too many ranges ignore the header"""
+    self.assertIsNone(httpd.parse_range("lines=0-9", 100))
+    self.assertIsNone(httpd.parse_range("bytes=9-0", 100))
+    self.assertIsNone(httpd.parse_range("bytes=a-", 100))
+    self.assertIsNone(httpd.parse_range("bytes=-", 100))
+    self.assertIsNone(httpd.parse_range("bytes=" + ",".join(["0-0"] * 17), 100))
+
+
+class Validators(unittest.TestCase):
+
+  def setUp(self):
+    self.validators = httpd.Validators((1, 38, 1000000000.5), 0.0)
+
+  def test_match(self):
+    """current ETag and Last-Modified match"""
+    self.assertTrue(self.validators.if_range(self.validators.etag))
+    self.assertTrue(self.validators.if_range(" %s " % self.validators.etag))
+    self.assertTrue(self.validators.if_range(self.validators.last_modified))
+
+  def test_matched_encoding(self):
+    """If-None-Match names the file or one of its compressed variants"""
+    etag = self.validators.etag
+    self.assertEqual(self.validators.matched_encoding(etag), "")
+    self.assertEqual(self.validators.matched_encoding('"1-26-0", W/' + etag), "")
+    self.assertEqual(self.validators.matched_encoding(etag[:-1] + '-gzip"'), "gzip")
+    self.assertEqual(self.validators.matched_encoding('W/' + etag[:-1] + '-br"'), "br")
+    self.assertIsNone(self.validators.matched_encoding('"1-26-0"'))
+    self.assertIsNone(self.validators.matched_encoding("*"))
+
+  def test_mismatch(self):
+    """other versions, weak and variant ETags do not match"""
+    self.assertFalse(self.validators.if_range('"1-26-0"'))
+    self.assertFalse(self.validators.if_range("W/" + self.validators.etag))
+    self.assertFalse(self.validators.if_range(self.validators.etag[:-1] + '-gzip"'))
+    self.assertFalse(self.validators.if_range("Thu, 01 Jan 1970 00:00:00 GMT"))
+
+
+class TimerWheel(unittest.TestCase):
+
+  def setUp(self):
+    self.wheel = asyncore_epoll.timer_wheel(resolution=0.1, slots=16)
+    self.start = asyncore_epoll.monotonic()
+    self.fired = []
+
+  def call_at(self, delay, name):
+    return self.wheel.call_at(self.start + delay, self.fired.append, name)
+
+  def test_order(self):
+    """due timers fire in order of their times"""
+    for delay, name in ((0.35, "c"), (0.1, "a"), (0.32, "b"), (5.0, "late")):
+      self.call_at(delay, name)
+    self.assertEqual(self.wheel.run(self.start + 0.05), 0)
+    self.assertEqual(self.wheel.run(self.start + 0.4), 3)
+    self.assertEqual(self.fired, ["a", "b", "c"])
+    self.assertEqual(len(self.wheel), 1)
+
+  def test_same_slot(self):
+    """timers of one slot fire only once due"""
+    self.call_at(0.21, "a")
+    self.call_at(0.29, "b")
+    self.wheel.run(self.start + 0.25)
+    self.assertEqual(self.fired, ["a"])
+    self.wheel.run(self.start + 0.3)
+    self.assertEqual(self.fired, ["a", "b"])
+
+  def test_later_turn(self):
+    """timers more than one turn ahead wait for their turn"""
+    self.call_at(0.15, "now")
+    self.call_at(1.6 + 0.15, "next turn")
+    self.wheel.run(self.start + 0.2)
+    self.assertEqual(self.fired, ["now"])
+    self.assertAlmostEqual(self.wheel.timeout(now=self.start + 0.2), 1.55, 3)
+    self.wheel.run(self.start + 1.8)
+    self.assertEqual(self.fired, ["now", "next turn"])
+
+  def test_idle_longer_than_turn(self):
+    """timers are fired after an idle period of several turns"""
+    self.call_at(0.5, "a")
+    self.call_at(3.0, "b")
+    self.assertEqual(self.wheel.run(self.start + 10.0), 2)
+    self.assertEqual(self.fired, ["a", "b"])
+    self.assertEqual(len(self.wheel), 0)
+
+  def test_cancel(self):
+    """cancelled timers do not fire"""
+    first = self.call_at(0.1, "a")
+    self.call_at(0.2, "b")
+    first.cancel()
+    first.cancel()
+    self.assertEqual(len(self.wheel), 1)
+    self.wheel.run(self.start + 0.3)
+    self.assertEqual(self.fired, ["b"])
+    self.assertIsNone(self.wheel.timeout(now=self.start + 0.3))
+
+  def test_timeout(self):
+    """timeout() until the earliest timer, at most default"""
+    self.assertIsNone(self.wheel.timeout())
+    self.assertEqual(self.wheel.timeout(30.0), 30.0)
+    self.call_at(2.0, "b")
+    self.call_at(0.5, "a")
+    self.assertAlmostEqual(self.wheel.timeout(30.0, self.start), 0.5, 3)
+    self.assertEqual(self.wheel.timeout(0.1, self.start), 0.1)
+    self.assertEqual(self.wheel.timeout(30.0, self.start + 1.0), 0.0)
+    self.wheel.run(self.start + 1.0)
+    self.assertAlmostEqual(self.wheel.timeout(30.0, self.start + 1.0), 1.0, 3)
+
+  def test_timeout_after_cancel(self):
+    """timeout() is not shorter than the earliest remaining timer after cancel and run"""
+    first = self.call_at(0.5, "a")
+    self.call_at(2.0, "b")
+    first.cancel()
+    self.wheel.run(self.start + 0.6)
+    self.assertAlmostEqual(self.wheel.timeout(30.0, self.start + 0.6), 1.4, 3)
+
+  def test_call_later(self):
+    """call_later() is relative to monotonic()"""
+    self.wheel.call_later(1.0, self.fired.append, "a")
+    delay = self.wheel.timeout(30.0)
+    self.assertTrue(0.9 < delay <= 1.0)
+
+
+class ThreadPool(unittest.TestCase):
+
+  def test_full_queue(self):
+    """calls submitted to a full queue are made by submit() and their callbacks are still queued"""
+    results = []
+    release = threading.Event()
+    pool = asyncore_epoll.thread_pool(1, lambda callback, *args: results.append(args), max_jobs=1)
+    try:
+      started = threading.Event()
+      pool.submit(lambda: started.set() or release.wait(10), (), None)
+      self.assertTrue(started.wait(10))
+      pool.submit(abs, (-1,), None)
+      caller = []
+      pool.submit(lambda: caller.append(threading.current_thread()), (), None)
+      self.assertEqual(caller, [threading.current_thread()])
+      pool.submit(int, ("x",), None)
+      self.assertEqual(len(results), 2)
+      self.assertIsInstance(results[1][1], ValueError)
+    finally:
+      release.set()
+      pool.close()
+
+
+class SharedFileCache(unittest.TestCase):
+
+  def setUp(self):
+    self.shared = shmcache.SharedFileCache(size=4096 + 64 * 16, slots=16)
+
+  def test_put_get(self):
+    """shared body is found by path and stat key"""
+    view = self.shared.put("/a", (1, 5, 1.0), b"hello")
+    self.assertEqual(bytes(view), b"hello")
+    self.assertEqual(bytes(self.shared.get("/a", (1, 5, 1.0))), b"hello")
+    self.assertIsNone(self.shared.get("/a", (1, 5, 2.0)))
+    self.assertIsNone(self.shared.get("/b", (1, 5, 1.0)))
+
+  def test_refused_bodies(self):
+    """missing, oversized and changed bodies are not shared"""
+    self.assertIsNone(self.shared.put("/a", (1, 5, 1.0), None))
+    self.assertIsNone(self.shared.put("/a", (1, 6, 1.0), b"hello"))
+    self.assertIsNone(self.shared.put("/a", (1, 8192, 1.0), b"x" * 8192))
+    self.assertIsNone(self.shared.get("/a", (1, 5, 1.0)))
+    self.assertIsNotNone(self.shared.put("/a", (1, 5, 1.0), b"hello"))
+
+  def test_full(self):
+    """files which do not fit any more stay unshared, shared ones are kept"""
+    self.assertIsNotNone(self.shared.put("/a", (1, 3000, 1.0), b"a" * 3000))
+    self.assertIsNone(self.shared.put("/b", (2, 3000, 1.0), b"b" * 3000))
+    self.assertTrue(self.shared.full)
+    self.assertEqual(bytes(self.shared.get("/a", (1, 3000, 1.0))), b"a" * 3000)
+    self.assertIsNotNone(self.shared.put("/c", (3, 500, 1.0), b"c" * 500))
+
+  def test_insert_without_shared_body(self):
+    """FileCache.insert() without data returns None when the shared body is gone"""
+    cache = httpd.FileCache(shared=self.shared)
+    self.assertIsNone(cache.insert("/a", (1, 5, 1.0), "text/plain"))
+    entry = cache.insert("/a", (1, 5, 1.0), "text/plain", b"hello")
+    self.assertEqual(bytes(entry.body), b"hello")
+    self.assertEqual(entry.size, 0)
+    self.assertIsNotNone(cache.insert("/a", (1, 5, 1.0), "text/plain"))
+
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
@@ -1,276 +1,1786 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from __future__ import print_function
+
 import sys
 import getopt
 import os
-import asyncore
-import asynchat
+import asyncore_epoll
+import asynchat_epoll
+import shmcache
+import metrics
+import accesslog
+import prefork
 import platform
 import re
 import socket
-import multiprocessing
+import string
+import struct
+import threading
 import logging
-from time import strftime, gmtime
+import signal
+import tempfile
+import zlib
+from calendar import timegm
+from collections import OrderedDict, deque
+from email.utils import parsedate
+from errno import EAGAIN, EWOULDBLOCK
+from time import strftime, gmtime, time
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile package on python 2
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    import asyncio
+except ImportError:
+    # python 2, only asyncore backend
+    asyncio = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BACKENDS = ("asyncore", "asyncio") if asyncio is not None else ("asyncore",)
+
+# Linux only
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+if str is bytes:
+    def latin1(text):
+        return text
+
+    def native(data):
+        return data
+else:
+    def latin1(text):
+        """returns bytes of response head"""
+        return text.encode("latin-1")
+
+    def native(data):
+        """returns str of received request head"""
+        return data.decode("latin-1")
+
+
+class RequestError(Exception):
+    """request can not be answered, status_line is sent and the connection is closed"""
+
+    def __init__(self, status_line):
+        Exception.__init__(self, status_line)
+        self.status_line = status_line
+
+
+class RequestParser(object):
+    """incremental parser of request heads: received data is appended to one reusable bytearray and
+    the search for the end of head continues where the previous one stopped"""
+    __slots__ = ['buffer', 'scanned', 'max_head_size']
+
+    def __init__(self, max_head_size=16384):
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.max_head_size = max_head_size
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_head(self):
+        """returns next complete request head without the empty line, None if it is not received yet.
+        Raises RequestError (431) if the head is longer than max_head_size"""
+        # the terminator may have started in the last 3 bytes of the previous scan
+        end = self.buffer.find(b"\r\n\r\n", max(0, self.scanned - 3))
+        if end < 0:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_head_size:
+                raise RequestError("431 Request Header Fields Too Large")
+            return None
+        if end > self.max_head_size:
+            raise RequestError("431 Request Header Fields Too Large")
+        head = bytes(self.buffer[:end])
+        # cheap: bytearray only moves its start when deleting from the front
+        del self.buffer[:end + 4]
+        self.scanned = 0
+        return head
+
+    def take(self, size):
+        """returns up to size bytes from the front of received data"""
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def take_line(self, limit):
+        """returns next line without CRLF, None if it is not received yet.
+        Raises RequestError (400) if the line is longer than limit"""
+        end = self.buffer.find(b"\r\n", max(0, self.scanned - 1))
+        if end < 0:
+            self.scanned = len(self.buffer)
+            if self.scanned > limit:
+                raise RequestError("400 Bad Request")
+            return None
+        if end > limit:
+            raise RequestError("400 Bad Request")
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 2]
+        self.scanned = 0
+        return line
+
+    def pending(self):
+        """returns number of received bytes not taken yet"""
+        return len(self.buffer)
+
+    def clear(self):
+        del self.buffer[:]
+        self.scanned = 0
+
+
+class RequestBody(object):
+    """moves request body (Content-Length bytes or chunked) from RequestParser to sink, a file-like object,
+    as it arrives, so the body is never buffered whole in memory"""
+    __slots__ = ['request', 'sink', 'max_size', 'chunked', 'received', 'remaining', 'state', 'trailer_size']
+
+    # states of chunked decoding
+    SIZE, DATA, DATA_END, TRAILER = range(4)
+    # chunk size line with extensions
+    max_size_line = 1024
+
+    def __init__(self, request, sink, max_size, length=None):
+        self.request = request
+        self.sink = sink
+        self.max_size = max_size
+        self.chunked = length is None
+        self.received = length or 0
+        # bytes left of the body (Content-Length) or of the current chunk
+        self.remaining = length or 0
+        self.state = RequestBody.SIZE if self.chunked else RequestBody.DATA
+        self.trailer_size = 0
+
+    def receive(self, parser):
+        """moves received body from parser to sink, returns True when the whole body is received.
+        Raises RequestError on malformed chunked encoding (400) or body longer than max_size (413)"""
+        while True:
+            if self.state == RequestBody.DATA:
+                while self.remaining:
+                    data = parser.take(self.remaining)
+                    if not data:
+                        return False
+                    self.sink.write(data)
+                    self.remaining -= len(data)
+                if not self.chunked:
+                    return True
+                self.state = RequestBody.DATA_END
+            elif self.state == RequestBody.SIZE:
+                line = parser.take_line(self.max_size_line)
+                if line is None:
+                    return False
+                size = line.split(b";", 1)[0].strip()
+                if not size or size.strip(b"0123456789abcdefABCDEF"):
+                    raise RequestError("400 Bad Request")
+                self.remaining = int(size, 16)
+                self.received += self.remaining
+                if self.received > self.max_size:
+                    raise RequestError("413 Payload Too Large")
+                self.state = RequestBody.DATA if self.remaining else RequestBody.TRAILER
+            elif self.state == RequestBody.DATA_END:
+                line = parser.take_line(2)
+                if line is None:
+                    return False
+                if line:
+                    raise RequestError("400 Bad Request")
+                self.state = RequestBody.SIZE
+            else:
+                line = parser.take_line(parser.max_head_size - self.trailer_size)
+                if line is None:
+                    return False
+                if not line:
+                    return True
+                # trailer fields are not used
+                self.trailer_size += len(line) + 2
+
+    def close(self):
+        self.sink.close()
+
+
+def parse_query(query):
+    """returns dict of key=value pairs of query string or url-encoded form"""
+    if not query:
+        return {}
+    parameters = {}
+    key_value_list = re.split(r'[&#;$]', query)
+    for pair in key_value_list:
+        key, _, value = pair.partition("=")
+        parameters[key] = value
+    return parameters
 
 
 class HTTPRequest(object):
-    __slots__ = ['headers', 'uri', 'http_version', 'body']
+    __slots__ = ['header_lines', 'fields', 'uri', 'http_version', 'body']
+
+    method = None
 
     def __init__(self, headers, uri="", http_version=1.1, body=None):
-        self.headers = headers
+        self.reset(headers, uri, http_version, body)
+
+    def reset(self, headers, uri="", http_version=1.1, body=None):
+        """(re)initializes the request, objects are reused through the free list of the server"""
+        self.header_lines = headers
+        self.fields = None
         self.uri = uri
         self.http_version = http_version
         self.body = body
 
+    @property
+    def headers(self):
+        """header values by lower-case name, repeated headers joined with ", ", built on first use"""
+        if self.fields is None:
+            fields = {}
+            for line in self.header_lines:
+                name, _, value = line.partition(":")
+                name = name.lower()
+                value = value.strip()
+                if name in fields:
+                    fields[name] += ", " + value
+                else:
+                    fields[name] = value
+            self.fields = fields
+        return self.fields
+
     def get_params(self, query=None):
         pass
 
+    def get_header(self, name, default=None):
+        """returns value of header with given name (case-insensitive)"""
+        return self.headers.get(name.lower(), default)
+
 
 class GETRequest(HTTPRequest):
+    __slots__ = []
 
-    def __init__(self, headers, uri="", http_version=1.0, body=None):
-        super(GETRequest, self).__init__(headers, uri=uri, http_version=http_version, body=body)
-        self.method = "GET"
+    method = "GET"
 
     def get_params(self, query=None):
-        if not query:
-            return {}
-        parameters = {}
-        key_value_list = re.split(r'[&#;$]', query)
-        for pair in key_value_list:
-            key, value = pair.split("=")
-            parameters[key] = value
-        return parameters
+        return parse_query(query)
 
 
 class HEADRequest(HTTPRequest):
+    __slots__ = []
 
-    def __init__(self, headers, uri="", http_version=1.0, body=None):
-        super(HEADRequest, self).__init__(headers, uri=uri, http_version=http_version, body=body)
-        self.method = "HEAD"
+    method = "HEAD"
 
 
 class POSTRequest(HTTPRequest):
+    __slots__ = []
 
-    def __init__(self, headers, uri="", http_version=1.0, body=None):
-        super(POSTRequest, self).__init__(headers, uri=uri, http_version=http_version, body=body)
-        self.method = "POST"
+    method = "POST"
 
     def get_params(self, query=None):
-        return self.body
+        """returns fields of url-encoded form in the body"""
+        if self.body is None or "application/x-www-form-urlencoded" not in self.get_header("Content-Type", ""):
+            return {}
+        self.body.seek(0)
+        form = native(self.body.read())
+        self.body.seek(0)
+        return parse_query(form)
+
+
+# request method -> class of its requests, other methods get 405
+REQUEST_CLASSES = {"HEAD": HEADRequest, "GET": GETRequest, "POST": POSTRequest}
 
 
 class ContentProducer(object):
+    """reads file in chunks, from offset and at most count bytes when they are given"""
+    __slots__ = ['fd', 'chunk_size', 'offset', 'remaining']
 
-    def __init__(self, file_descriptor, chunk_size=4096):
+    def __init__(self, file_descriptor, chunk_size=4096, offset=0, count=None):
         self.fd = file_descriptor
         self.chunk_size = chunk_size
+        self.offset = offset
+        self.remaining = count
 
     def more(self):
         if self.fd:
-            data = self.fd.read(self.chunk_size)
+            if self.offset:
+                self.fd.seek(self.offset)
+                self.offset = 0
+            size = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+            data = self.fd.read(size) if size else b""
+            if data:
+                if self.remaining is not None:
+                    self.remaining -= len(data)
+                return data
+            self.fd.close()
+            self.fd = None
+        return b""
+
+
+class SendfileProducer(object):
+    """streams file by sendfile(2): the kernel copies data from page cache to the socket"""
+    __slots__ = ['fd', 'offset', 'remaining']
+
+    def __init__(self, file_descriptor, offset=0, count=None):
+        self.fd = file_descriptor
+        self.offset = offset
+        if count is None:
+            count = os.fstat(file_descriptor.fileno()).st_size - offset
+        self.remaining = count
+
+    def transmit(self, sock_fileno):
+        """sends next part of the file, returns number of bytes sent (0 if socket buffer is full)"""
+        try:
+            sent = sendfile(sock_fileno, self.fd.fileno(), self.offset, self.remaining)
+        except OSError as why:
+            if why.args[0] in (EAGAIN, EWOULDBLOCK):
+                return 0
+            raise
+        if not sent:
+            # file was truncated under us, nothing more to send
+            self.remaining = 0
+        self.offset += sent
+        self.remaining -= sent
+        return sent
+
+    def done(self):
+        return self.remaining <= 0
+
+    def more(self):
+        """fallback for consumers which can not sendfile"""
+        if self.fd and self.remaining > 0:
+            self.fd.seek(self.offset)
+            data = self.fd.read(min(self.remaining, 4096))
+            self.offset += len(data)
+            self.remaining = self.remaining - len(data) if data else 0
             if data:
                 return data
+        self.close()
+        return b""
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+
+class PrefetchProducer(object):
+    """reads file by the thread pool one chunk ahead of the socket, so the event loop never waits for the disk.
+    more() returns the next chunk, None while it is being read (on_ready is called once it is there)
+    and empty string at the end"""
+    __slots__ = ['fd', 'thread_pool', 'chunk_size', 'offset', 'unread', 'remaining', 'chunk', 'reading', 'closing',
+                 'failed', 'on_ready']
+
+    def __init__(self, file_descriptor, thread_pool, offset=0, count=None, chunk_size=65536):
+        self.fd = file_descriptor
+        self.thread_pool = thread_pool
+        self.chunk_size = chunk_size
+        if count is None:
+            count = os.fstat(file_descriptor.fileno()).st_size - offset
+        # next chunk to read, bytes not given to the thread pool and bytes not returned by more()
+        self.offset = offset
+        self.unread = count
+        self.remaining = count
+        self.chunk = None
+        self.reading = False
+        self.closing = False
+        self.failed = False
+        self.on_ready = None
+
+    def read_ahead(self):
+        if self.reading or self.fd is None or self.unread <= 0:
+            return
+        size = min(self.chunk_size, self.unread)
+        self.reading = True
+        self.thread_pool.submit(self.read, (self.offset, size), self.done_reading)
+        self.offset += size
+        self.unread -= size
+
+    def read(self, offset, size):
+        """runs in the thread pool"""
+        self.fd.seek(offset)
+        return self.fd.read(size)
+
+    def done_reading(self, data, error):
+        self.reading = False
+        if self.closing:
+            self.close()
+            return
+        if error is not None or not data:
+            # the file was truncated or can not be read, the response can not be completed
+            self.failed = True
+            self.unread = 0
+            data = b""
+        self.chunk = data
+        on_ready, self.on_ready = self.on_ready, None
+        if on_ready is not None:
+            on_ready()
+
+    def more(self):
+        chunk = self.chunk
+        if chunk is None:
+            self.read_ahead()
+            if self.reading:
+                return None
+            self.close()
+            return b""
+        self.chunk = None
+        if not chunk:
+            self.close()
+            return b""
+        self.remaining -= len(chunk)
+        self.read_ahead()
+        return chunk
+
+    def close(self):
+        if self.reading:
+            # the thread still reads the descriptor, it is closed by done_reading()
+            self.closing = True
+        elif self.fd:
             self.fd.close()
             self.fd = None
-        return ""
 
 
-class HTTPHandler(asynchat.async_chat):
+def parse_range(value, size, max_ranges=16):
+    """returns (first, last) byte positions of satisfiable ranges of Range header value for file of given size,
+    empty list if none is satisfiable, None if the header is malformed or asks for too many ranges"""
+    unit, _, specs = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition("-")
+        first = first.strip()
+        last = last.strip()
+        if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # suffix range: the last bytes of the file, an empty file has none
+            if int(last) and size:
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            ranges.append((first, min(int(last), size - 1) if last else size - 1))
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
+def render_headers(headers):
+    """returns header lines for given (name, value) pairs"""
+    return "".join(["%s: %s\r\n" % (name, value) for name, value in headers])
+
+
+def as_bytes(body):
+    """returns copy of cached body (memoryview or python 2 buffer) as string"""
+    if isinstance(body, memoryview):
+        return body.tobytes()
+    return body[:]
+
+
+class HeaderBuilder(object):
+    """renders status line and all headers in one buffer: static headers are rendered once, Date by refresh(),
+    which the server calls every second"""
+
+    def __init__(self, **static_headers):
+        self.static = render_headers(static_headers.items())
+        self.refresh(time())
+
+    def refresh(self, now):
+        self.common = self.static + "Date: " + BaseHTTPServer.get_date(int(now)) + "\r\n"
+
+    def build(self, status_line, headers):
+        """returns response head: status line, common headers, given rendered headers and the empty line"""
+        return latin1(status_line + "\r\n" + self.common + headers + "\r\n")
+
+
+class CacheEntry(object):
+    __slots__ = ['body', 'headers', 'stat_key', 'checked', 'size']
+
+    def __init__(self, body, headers, stat_key, checked, size):
+        self.body = body
+        self.headers = headers
+        self.stat_key = stat_key
+        self.checked = checked
+        self.size = size
+
+
+class FileCache(object):
+    """per-worker LRU cache of small files (body and entity headers), revalidated by stat every validity seconds.
+    With shared (shmcache.SharedFileCache) bodies live in memory shared by all workers and only the index is local"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_size=1024 * 1024, validity=1.0, shared=None):
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.validity = validity
+        self.shared = shared
+        self.size = 0
+
+    @staticmethod
+    def stat_key(st):
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def fits(self, size):
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def peek(self, path):
+        """returns cached entry for path or None, without checking the file"""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.entries[path] = entry
+        return entry
+
+    def stale(self, entry):
+        """returns True if the file of entry has to be checked on disk"""
+        return metrics.clock() - entry.checked > self.validity
+
+    def get(self, path):
+        """returns cached entry for path or None if it is absent or the file was changed"""
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return None
+        now = metrics.clock()
+        if now - entry.checked > self.validity:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or FileCache.stat_key(st) != entry.stat_key:
+                self.size -= entry.size
+                return None
+            entry.checked = now
+        # the most recently used entries are kept at the end
+        self.entries[path] = entry
+        return entry
+
+    def load(self, path, content, content_type):
+        """reads opened file into the cache, closes it and returns new entry"""
+        try:
+            stat_key = FileCache.stat_key(os.fstat(content.fileno()))
+            data = None
+            if self.shared is None or self.shared.get(path, stat_key) is None:
+                data = content.read()
+            entry = self.insert(path, stat_key, content_type, data)
+            if entry is None:
+                # another worker shared a newer version of the file meanwhile
+                entry = self.insert(path, stat_key, content_type, content.read())
+        finally:
+            content.close()
+        return entry
+
+    def insert(self, path, stat_key, content_type, data=None):
+        """caches data read from file with given stat_key (or its body already in shared memory),
+        returns new entry, None without data when the body is not in shared memory"""
+        body = self.shared.get(path, stat_key) if self.shared is not None else None
+        # bodies in shared memory do not take memory of this worker
+        size = 0
+        if body is None:
+            if data is None:
+                return None
+            if self.shared is not None:
+                body = self.shared.put(path, stat_key, data)
+            if body is None:
+                body = memoryview(data)
+                size = len(data)
+        entry = CacheEntry(body, render_headers((("Content-Type", content_type), ("Content-Length", len(body)))),
+                           stat_key, metrics.clock(), size)
+        replaced = self.entries.pop(path, None)
+        if replaced is not None:
+            self.size -= replaced.size
+        self.size += size
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+        self.entries[path] = entry
+        return entry
+
+
+def load_file(path, read_limit=0, stat_key=None):
+    """opens file, returns (file, stat, data): only stat when it still matches stat_key of cached entry,
+    whole content of files up to read_limit bytes (their file is closed then). Runs in the thread pool"""
+    content = open(path, "rb")
+    try:
+        st = os.fstat(content.fileno())
+        if stat_key is not None and FileCache.stat_key(st) == stat_key:
+            content.close()
+            return None, st, None
+        if st.st_size <= read_limit:
+            data = content.read()
+            content.close()
+            return None, st, data
+    except Exception:
+        content.close()
+        raise
+    return content, st, None
+
+
+class Validators(object):
+    __slots__ = ['stat_key', 'etag', 'last_modified', 'mtime', 'headers', 'checked']
+
+    def __init__(self, stat_key, checked):
+        self.stat_key = stat_key
+        ino, size, mtime = stat_key
+        self.etag = '"%x-%x-%x"' % (ino, size, int(mtime * 1000000))
+        self.mtime = int(mtime)
+        self.last_modified = BaseHTTPServer.get_date(self.mtime)
+        self.headers = render_headers((("ETag", self.etag), ("Last-Modified", self.last_modified)))
+        self.checked = checked
+
+    def variant_headers(self, encoding):
+        """returns validators of the representation with given Content-Encoding, its ETag gets a suffix"""
+        return render_headers((("ETag", self.etag[:-1] + "-" + encoding + '"'), ("Last-Modified", self.last_modified)))
+
+    def if_range(self, value):
+        """returns True if If-Range value names the current version of the file (strong comparison)"""
+        value = value.strip()
+        if value[:1] == '"':
+            return value == self.etag
+        return value == self.last_modified
+
+    def matched_encoding(self, if_none_match):
+        """returns Content-Encoding of the representation named by If-None-Match value, "" for the file itself,
+        None if it names none of the current version"""
+        # weak comparison, ETags of compressed variants match as well
+        variant = self.etag[:-1] + "-"
+        for tag in if_none_match.split(","):
+            tag = tag.strip().replace("W/", "", 1)
+            if tag == self.etag:
+                return ""
+            if tag.startswith(variant) and tag.endswith('"'):
+                return tag[len(variant):-1]
+        return None
+
+    def not_modified(self, http_request):
+        """returns True if conditional headers of GET or HEAD request match, so 304 can be sent"""
+        if_none_match = http_request.get_header("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or self.matched_encoding(if_none_match) is not None
+        if_modified_since = http_request.get_header("If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        # clients usually send back the value they got
+        if if_modified_since == self.last_modified:
+            return True
+        since = parsedate(if_modified_since)
+        return since is not None and self.mtime <= timegm(since)
+
+
+class ValidatorCache(object):
+    """ETag and Last-Modified of files by path, derived from stat (inode, size, mtime) and memoized for
+    validity seconds, so revalidation of an unchanged file is a dict lookup without file system access"""
+
+    def __init__(self, validity=1.0, limit=16384):
+        self.entries = {}
+        self.validity = validity
+        self.limit = limit
+
+    def get(self, path):
+        """returns memoized validators of path or None if they are older than validity"""
+        validators = self.entries.get(path)
+        if validators is None or metrics.clock() - validators.checked > self.validity:
+            return None
+        return validators
+
+    def update(self, path, stat_key):
+        """returns validators for given FileCache.stat_key and memoizes them"""
+        validators = Validators(stat_key, metrics.clock())
+        if len(self.entries) >= self.limit:
+            self.entries.clear()
+        self.entries[path] = validators
+        return validators
+
+
+def gzip_compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data, level):
+    return brotli.compress(data, quality=level)
+
+
+class CompressionCache(object):
+    """Content-Encoding negotiation and per-worker LRU cache of compressed variants keyed by path, stat
+    (inode, size, mtime) and encoding. A variant is read from the precompressed sibling file (path.br, path.gz)
+    when it is not older than the file, otherwise the file is compressed; both run in the thread pool and the
+    file is sent as is until its variant is ready"""
+
+    compressible = frozenset(("text/html", "text/css", "application/javascript"))
+
+    # encoding -> suffix of precompressed sibling, compress function; the first one is preferred
+    encodings = OrderedDict([("br", (".br", brotli_compress)), ("gzip", (".gz", gzip_compress))])
+    if brotli is None:
+        del encodings["br"]
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, level=6, min_size=256, max_file_size=16 * 1024 * 1024):
+        # key -> CacheEntry, or False for files compression does not make smaller
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.max_bytes = max_bytes
+        self.level = level
+        self.min_size = min_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        # Accept-Encoding value -> acceptable encodings in order of preference
+        self.negotiated = {}
+        self.negotiated_limit = 256
+
+    def accepted(self, accept_encoding):
+        """returns supported encodings acceptable for Accept-Encoding value, the best first"""
+        encodings = self.negotiated.get(accept_encoding)
+        if encodings is not None:
+            return encodings
+        weights = {}
+        for item in accept_encoding.lower().split(","):
+            name, _, parameters = item.partition(";")
+            weight = 1.0
+            parameters = parameters.strip()
+            if parameters.startswith("q="):
+                try:
+                    weight = float(parameters[2:])
+                except ValueError:
+                    weight = 0.0
+            weights[name.strip()] = weight
+        default = weights.get("*", 0.0)
+        # equal weights are ordered by preference of the server
+        candidates = [(weights.get(name, default), -order, name) for order, name in enumerate(self.encodings)]
+        encodings = tuple(name for weight, _, name in sorted(candidates, reverse=True) if weight > 0)
+        if len(self.negotiated) >= self.negotiated_limit:
+            self.negotiated.clear()
+        self.negotiated[accept_encoding] = encodings
+        return encodings
+
+    def get(self, path, stat_key, content_type, accept_encoding, thread_pool):
+        """returns (encoding, CacheEntry) of the best cached variant acceptable for the client or None.
+        Missing variant of the best encoding is prepared by thread_pool (or right away without it)"""
+        size = stat_key[1]
+        if not accept_encoding or size < self.min_size or size > self.max_file_size:
+            return None
+        scheduled = False
+        for encoding in self.accepted(accept_encoding):
+            key = (path, stat_key, encoding)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                if entry:
+                    return encoding, entry
+                continue
+            if scheduled or key in self.pending:
+                continue
+            scheduled = True
+            if thread_pool is None:
+                self.store(key, content_type, self.prepare(key), None)
+                entry = self.entries.get(key)
+                if entry:
+                    return encoding, entry
+            else:
+                self.pending.add(key)
+                thread_pool.submit(self.prepare, (key,),
+                                   lambda data, error, key=key: self.store(key, content_type, data, error))
+        return None
+
+    def prepare(self, key):
+        """returns compressed body for key, None if it is not smaller than the file; runs in the thread pool"""
+        path, stat_key, encoding = key
+        suffix, compress = self.encodings[encoding]
+        try:
+            with open(path + suffix, "rb") as sibling:
+                if os.fstat(sibling.fileno()).st_mtime >= stat_key[2]:
+                    return sibling.read()
+        except IOError:
+            pass
+        with open(path, "rb") as original:
+            if FileCache.stat_key(os.fstat(original.fileno())) != stat_key:
+                return None
+            data = compress(original.read(), self.level)
+        return data if len(data) < stat_key[1] else None
+
+    def store(self, key, content_type, data, error):
+        """puts prepared variant to the cache, called in the event loop"""
+        self.pending.discard(key)
+        if error is not None:
+            log.debug("Compression of %s failed: %s", key[0], error)
+            return
+        if data is None or len(data) > self.max_bytes:
+            self.entries[key] = False
+            return
+        entry = CacheEntry(memoryview(data),
+                           render_headers((("Content-Type", content_type), ("Content-Encoding", key[2]),
+                                           ("Content-Length", len(data)), ("Vary", "Accept-Encoding"))),
+                           key[1], metrics.clock(), len(data))
+        self.size += entry.size
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            if evicted:
+                self.size -= evicted.size
+        self.entries[key] = entry
+
+
+class DocumentIndex(object):
+    """set of file paths under document root rebuilt in background thread, so requests for missing files
+    are answered without touching the disk"""
+
+    def __init__(self, document_root, rescan_interval=5.0, max_files=100000):
+        if document_root[-1:] == '/':
+            document_root = document_root[:-1]
+        self.document_root = document_root
+        self.rescan_interval = rescan_interval
+        self.max_files = max_files
+        self.scanning = False
+        self.files = self.scan()
+
+    def scan(self):
+        """returns new set of files in the document root or None if it has more than max_files files.
+        Only names are kept, os.walk() lists them without a stat() per file (on python 3)"""
+        files = set()
+        join = os.path.join
+        for dir_path, _, file_names in os.walk(self.document_root or '/', followlinks=True):
+            for name in file_names:
+                files.add(join(dir_path, name))
+            if len(files) > self.max_files:
+                log.debug("Document root has more than %d files, index disabled", self.max_files)
+                return None
+        return files
+
+    def may_exist(self, path):
+        return self.files is None or path in self.files
+
+    def refresh(self):
+        """starts rescan of the document root unless one is running, the server calls it every rescan_interval"""
+        if self.scanning:
+            return
+        self.scanning = True
+        thread = threading.Thread(target=self._rescan)
+        thread.daemon = True
+        thread.start()
+
+    def _rescan(self):
+        try:
+            self.files = self.scan()
+        finally:
+            self.scanning = False
+
+
+class HTTPHandler(asynchat_epoll.async_chat):
+
+    # bodies up to this size are pushed in one buffer together with headers
+    coalesce_size = 16384
 
     def __init__(self, server, sock, addr):
-        asynchat.async_chat.__init__(self, sock=sock)
+        asynchat_epoll.async_chat.__init__(self, sock=sock)
         self.server = server
+        self.parser = RequestParser(server.max_head_size)
+        self.metrics = server.metrics
+        self.start(addr)
+
+    def reuse(self, sock, addr):
+        """takes a new connection, the handler comes from the free list of the server"""
+        sock.setblocking(0)
+        self.set_socket(sock)
+        self.connected = True
+        self.closing = False
+        self.ac_in_buffer = b''
+        del self.incoming[:]
+        self.producer_fifo.clear()
+        self.parser.clear()
+        self.start(addr)
+
+    def start(self, addr):
+        """initializes the state of the connection"""
         self.addr = addr
-        self.set_terminator("\r\n\r\n")
-        self.max_buffer_size = 256
-        self.ibuffer = b""
+        # RequestBody of the request which body is being received
+        self.request_body = None
+        # the response waits for the thread pool
+        self.waiting = False
+        self.requests = 0
+        self.persistent = True
+        self.last_activity = metrics.clock()
+        self.accepted = metrics.clock()
+        # when the pending request head started to arrive, when output last made progress
+        self.head_started = self.last_activity
+        self.last_write = self.last_activity
+        # response bytes queued in producer_fifo
+        self.buffered = 0
+        # timer of the server checking the timeouts, when it fires
+        self.timer = None
+        self.timer_due = None
+        self.corked = False
+        self.server.watch(self)
+
+    def readable(self):
+        return self.persistent and not self.waiting and self not in self.server.throttled
+
+    def handle_read(self):
+        # replaces terminator search of async_chat, which rescans and copies the whole input on every read
+        try:
+            data = self.recv(self.ac_in_buffer_size)
+        except socket.error:
+            self.handle_error()
+            return
+        if data and self.persistent:
+            if not self.parser.pending():
+                self.head_started = metrics.clock()
+                self.server.watch(self)
+            self.parser.feed(data)
+            self.server.handle_requests(self)
+
+    def end_response(self, keep_alive):
+        """waits for the next request on the connection or closes it once the response is sent"""
+        if keep_alive:
+            self.last_activity = metrics.clock()
+        else:
+            self.persistent = False
+            self.close_when_done()
 
-    def collect_incoming_data(self, data):
-        if len(self.ibuffer) > self.max_buffer_size:
-            self.ibuffer = b""
-        self.ibuffer += data
+    def buffered_bytes(self):
+        return self.buffered
 
-    def found_terminator(self):
-        http_request = self.server.parse_request(self.ibuffer)
-        self.server.handle_request(self, http_request)
+    def has_output(self):
+        return bool(self.producer_fifo)
 
-    def send_response(self, st_line, **response_headers):
-        self.push(st_line + "\r\n")
-        for hdr, hdr_v in response_headers.items():
-            self.push(str(hdr) + ": " + str(hdr_v) + "\r\n")
-        self.push("\r\n")
+    def throttle(self, throttled):
+        # readable() follows server.throttled
+        self.update_interest()
 
+    def abort(self):
+        self.close()
 
-class HTTPServer(asyncore.dispatcher):
+    def check_progress(self, now):
+        # handle_write() notes the progress
+        pass
+
+    def account(self, size):
+        self.buffered += size
+        self.server.buffered += size
+
+    def push(self, data, send=True):
+        if not self.connected:
+            # closed while the response was being pushed (e.g. parts of multipart/byteranges after a reset),
+            # close() has released what was counted already
+            return
+        idle = not self.producer_fifo
+        if idle:
+            self.last_write = metrics.clock()
+        self.account(len(data))
+        asynchat_epoll.async_chat.push(self, data, send)
+        if idle:
+            self.server.watch(self)
+
+    def push_with_producer(self, producer):
+        if not self.connected:
+            if isinstance(producer, (SendfileProducer, PrefetchProducer)):
+                producer.close()
+            return
+        idle = not self.producer_fifo
+        if idle:
+            self.last_write = metrics.clock()
+        asynchat_epoll.async_chat.push_with_producer(self, producer)
+        if idle:
+            self.server.watch(self)
+
+    def handle_write(self):
+        self.last_write = metrics.clock()
+        self.initiate_send()
+        if self in self.server.throttled:
+            self.server.resume(self)
+
+    def writable(self):
+        first = self.producer_fifo[0] if self.producer_fifo else None
+        if isinstance(first, PrefetchProducer) and first.on_ready is not None:
+            # nothing to send until the chunk is read
+            return False
+        return asynchat_epoll.async_chat.writable(self)
+
+    def prefetched(self):
+        if self.connected:
+            self.update_interest()
+            self.initiate_send()
+
+    def file_follows(self):
+        """returns True if the buffers at the head of producer_fifo are followed by a file sent by sendfile"""
+        for item in self.producer_fifo:
+            if isinstance(item, SendfileProducer):
+                return True
+            if not item or not isinstance(item, asynchat_epoll._buffer_types):
+                return False
+        return False
+
+    def cork(self, corked):
+        """holds partial frames in the kernel while the head of a response waits for the file sent after it"""
+        self.corked = corked
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, TCP_CORK, int(corked))
+        except socket.error:
+            pass
+
+    def initiate_send(self):
+        first = self.producer_fifo[0] if self.producer_fifo else None
+        if isinstance(first, (PrefetchProducer, ContentProducer)) and self.connected:
+            data = first.more()
+            if data is None:
+                first.on_ready = self.prefetched
+                self.update_interest()
+                return
+            if data:
+                self.account(len(data))
+                self.producer_fifo.appendleft(data)
+            else:
+                self.producer_fifo.popleft()
+                if getattr(first, "failed", False):
+                    self.handle_close()
+                    return
+            first = self.producer_fifo[0] if self.producer_fifo else None
+        if not isinstance(first, SendfileProducer) or not self.connected:
+            if self.server.tcp_cork and not self.corked and first and self.file_follows():
+                self.cork(True)
+            asynchat_epoll.async_chat.initiate_send(self)
+            if not self.corked:
+                return
+            first = self.producer_fifo[0] if self.producer_fifo else None
+            if not isinstance(first, SendfileProducer) or not self.connected:
+                # the head is not sent completely yet, the file waits for the next writable event
+                return
+        try:
+            sent = first.transmit(self._fileno)
+        except OSError as why:
+            if why.args[0] in asyncore_epoll._DISCONNECTED:
+                self.handle_close()
+            else:
+                self.handle_error()
+            return
+        if self.corked:
+            # the head and the first part of the file share packets
+            self.cork(False)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.BYTES_SENT, sent)
+        if first.done():
+            first.close()
+            self.producer_fifo.popleft()
+        else:
+            # the socket buffer is full, wait for the next writable event
+            self._would_block(asyncore_epoll._POLLOUT)
+
+    def send(self, data):
+        sent = asynchat_epoll.async_chat.send(self, data)
+        self.account(-sent)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.BYTES_SENT, sent)
+        return sent
+
+    def sendmsg(self, buffers):
+        sent = asynchat_epoll.async_chat.sendmsg(self, buffers)
+        self.account(-sent)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.BYTES_SENT, sent)
+        return sent
+
+    def close(self):
+        # a handler waiting for the thread pool is still referenced by its callback
+        reusable = self.connected and not self.waiting
+        self.persistent = False
+        self.server.throttled.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.account(-self.buffered)
+        for producer in self.producer_fifo:
+            if isinstance(producer, (SendfileProducer, PrefetchProducer)):
+                producer.close()
+        if self.request_body is not None:
+            self.request_body.close()
+            self.request_body = None
+        if self.metrics is not None and self.connected:
+            self.metrics.dec(metrics.CONNECTIONS_ACTIVE)
+        asynchat_epoll.async_chat.close(self)
+        if reusable and len(self.server.free_handlers) < self.server.free_list_size:
+            self.server.free_handlers.append(self)
+
+    def send_response(self, header, body=None, more=False):
+        """pushes rendered status line and headers, they go out in one write with the body (by sendmsg, without
+        sendmsg small body is copied to the same buffer). With more the write waits for the producers which
+        follow"""
+        if body is None:
+            self.push(header, not more)
+        elif len(body) <= self.coalesce_size and not asynchat_epoll._sendmsg:
+            self.push(header + as_bytes(body), not more)
+        else:
+            self.push(header, False)
+            self.push(body, not more)
+
+
+def somaxconn():
+    """returns maximum listen backlog allowed by the kernel"""
+    try:
+        with open("/proc/sys/net/core/somaxconn") as limit:
+            return int(limit.read())
+    except (IOError, ValueError):
+        return socket.SOMAXCONN
+
+
+def listening_socket(address, port, backlog=None, reuse_port=False):
+    """returns bound listening socket, with reuse_port every worker binds its own socket to the same port
+    and the kernel balances new connections between their accept queues"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(backlog or somaxconn())
+    return sock
+
+
+class BaseHTTPServer(object):
+    """request pipeline shared by the event loop backends: parse_request -> uri_resolve -> handle_request.
+    Connections (channels) give it requests, addr, accepted, send_response, push_with_producer and end_response"""
 
     index = "index.html"
 
-    __encoded_chars = {"%20": ' ', "%21": '!', "%22": "\"", "%23": '#', "%24": '$', "%25": '%', "%26": '&',
-                       "%27": '\'', "%28": '(', "%29": ')', "%30": "0", "%31": "1", "%32": "2", "%33": "3",
-                       "%34": '4', "%35": '5', "%36": '6', "%37": '7', "%38": '8', "%39": '9', "%40": '@',
-                       "%41": 'A', "%42": 'B', "%43": 'C', "%44": 'D', "%45": 'E', "%46": 'F', "%47": 'G',
-                       "%48": 'H', "%49": 'I',  "%4A": 'J', "%4B": 'K', "%4C": 'L', "%4D": 'M', "%4E": 'N',
-                       "%4F": 'O', "%50": 'P', "%51": 'Q', "%52": 'R', "%53": 'S', "%54": 'T', "%55": 'U',
-                       "%56": 'V', "%57": 'W', "%58": 'X', "%59": 'Y', "%5A": 'Z', "%5B": '[', "%5C": '\\',
-                       "%5D": ']', "%5E": '^', "%5F": '_', "%60": ']', "%61": 'a', "%62": 'b', "%63": 'c',
-                       "%64": 'd', "%65": 'e', "%66": 'f', "%67": 'g', "%68": 'h', "%69": 'i', "%6A": 'j',
-                       "%6B": 'k', "%6C": 'l', "%6D": 'm', "%6E": 'n', "%6F": 'o', "%70": 'p', "%71": 'q',
-                       "%72": 'r', "%73": 's', "%74": 't', "%75": 'u', "%76": 'v', "%77": 'w', "%78": 'x',
-                       "%79": 'y', "7A": 'z', "7B": '{', "7C": '|', "7D": '}', "7E": '~', "7F": ' ',
-                       "%2B": '+', "%2C": ',', "%2D": '-', "%2E": '.',  "%2F": '/', "%3A": ':', "%3B": ';',
-                       "%3C": '<', "%3D": '=', "%3E": '>', "%3F": '?',  "+": ' '}
+    # Range header with more ranges gets the whole file
+    max_ranges = 16
+
+    # two hex digits of "%XX" escape in any case -> decoded byte
+    __hex_bytes = dict(((high + low).encode("ascii"), struct.pack("B", int(high + low, 16)))
+                       for high in string.hexdigits for low in string.hexdigits)
+
     __content_types = {"html": "text/html", "css": "text/css", "js": "application/javascript",
                        "jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
                        "gif": "image/gif", "swf": "application/x-shockwave-flash"}
 
-    def __init__(self, address="", port=8080, document_root="/var/www/html", forbidden=""):
-        asyncore.dispatcher.__init__(self)
-        self.address = address
-        self.port = port
+    def __init__(self, document_root="/var/www/html", forbidden="", keepalive_timeout=15, keepalive_requests=100,
+                 cache=None, document_index=None, metrics=None, status_url=None, access_log=None,
+                 max_head_size=16384, max_headers=100, max_body_size=10 * 1024 * 1024, body_spool_size=65536,
+                 validators=None, compression=None, fs_offload=False, send_buffer_size=262144,
+                 memory_budget=64 * 1024 * 1024, header_timeout=10, body_timeout=30, write_timeout=60,
+                 tcp_nodelay=True, tcp_cork=True):
         self.document_root = document_root
         self.forbidden_methods = forbidden.split(',')
+        self.keepalive_timeout = keepalive_timeout
+        self.keepalive_requests = keepalive_requests
+        self.cache = cache
+        self.document_index = document_index
+        # ValidatorCache for conditional requests
+        self.validators = validators
+        # CompressionCache of gzip and brotli variants, they are prepared by thread_pool of the backend
+        self.compression = compression
+        self.thread_pool = None
+        # open, stat and read files in thread_pool, so a slow disk does not stall the event loop
+        self.fs_offload = fs_offload
+        # connections with more response bytes queued in memory stop reading and answering requests,
+        # as well as all connections with queued bytes while the worker has more than memory_budget queued
+        self.send_buffer_size = send_buffer_size
+        self.memory_budget = memory_budget
+        self.buffered = 0
+        self.throttled = set()
+        # seconds to receive a request head, between parts of a request body and for any progress of writes
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.write_timeout = write_timeout
+        # TCP_NODELAY on accepted sockets, responses are written in one call anyway; TCP_CORK while the head of
+        # a response and the start of its file are sent, so they share packets
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_cork = tcp_cork and TCP_CORK is not None
+        # files are sent by SendfileProducer, backends without sendfile(2) read them in chunks instead
+        self.zero_copy = sendfile is not None
+        # metrics.WorkerMetrics of this worker, served in Prometheus text format at status_url
+        self.metrics = metrics
+        self.status_url = status_url
+        # accesslog.AccessLog, records are written by its own thread
+        self.access_log = access_log
+        # longer request heads get 431, as well as heads with more header lines
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
+        # longer request bodies get 413, bodies up to body_spool_size are kept in memory
+        self.max_body_size = max_body_size
+        self.body_spool_size = body_spool_size
+        # set by shutdown(): no new connections, open ones are closed after their current response
+        self.draining = False
+        self.drain_deadline = None
+        # answered requests (by method) and closed connections kept for reuse, at most free_list_size of each
+        self.free_list_size = 256
+        self.free_requests = dict((method, []) for method in REQUEST_CLASSES)
+        self.free_handlers = []
+        # raw path of recent requests -> resolved location
+        self.resolved = {}
+        self.resolved_limit = 1024
+        self.header_builder = HeaderBuilder(Host=socket.gethostname(), Server=BaseHTTPServer.get_server())
+        # separator of multipart/byteranges responses
+        self.boundary = "%x" % struct.unpack("Q", os.urandom(8))
         if self.document_root[-1:] == '/':
             self.document_root = self.document_root[:-1]
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        self.bind((self.address, self.port))
-        self.listen(5)
-        log.debug("Listening on address %s:%s", address, port)
-
-    def serve_forever(self):
-        try:
-            asyncore.loop(timeout=60, use_poll=True)
-        except KeyboardInterrupt:
-            log.debug("Close worker")
-            asyncore.close_all()
-        finally:
-
-            self.close()
-
-    def handle_accept(self):
-        conn, addr = self.accept()
-        if conn is not None and addr is not None:
-            HTTPHandler(self, sock=conn, addr=addr)
+    def shutdown(self, timeout=30.0):
+        """starts graceful shutdown, safe to call from signal handler"""
+        if not self.draining:
+            self.drain_deadline = metrics.clock() + timeout
+            self.draining = True
+
+    def keep_alive(self, channel, http_request):
+        """returns True if the connection can be reused after the response (HTTP/1.1 defaults or keep-alive)"""
+        if not self.keepalive_timeout or channel.requests >= self.keepalive_requests or self.draining:
+            return False
+        connection = [token.strip() for token in http_request.get_header("Connection", "").lower().split(",")]
+        if http_request.http_version == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
+    def handle_requests(self, channel):
+        """answers complete requests received by channel.parser, bodies are streamed to body_sink().
+        Requests wait while the channel waits for the thread pool, so responses keep their order"""
+        while channel.persistent:
+            if channel.waiting:
+                return
+            if self.congested(channel):
+                self.throttled.add(channel)
+                channel.throttle(True)
+                return
+            try:
+                if channel.request_body is not None:
+                    channel.last_activity = metrics.clock()
+                    if not channel.request_body.receive(channel.parser):
+                        return
+                    http_request = channel.request_body.request
+                    http_request.body = channel.request_body.sink
+                    http_request.body.seek(0)
+                    channel.request_body = None
+                else:
+                    request = channel.parser.next_head()
+                    if request is None:
+                        return
+                    channel.requests += 1
+                    if self.metrics is not None:
+                        started = metrics.clock()
+                        http_request = self.parse_request(request)
+                        self.metrics.observe(metrics.PARSE, metrics.clock() - started)
+                    else:
+                        http_request = self.parse_request(request)
+                    if http_request is not None and self.start_body(channel, http_request):
+                        self.watch(channel)
+                        continue
+            except RequestError as error:
+                self.send_error(channel, error.status_line)
+                return
+            try:
+                self.handle_request(channel, http_request)
+            finally:
+                if http_request is not None:
+                    if http_request.body is not None:
+                        http_request.body.close()
+                    # a request waiting for the thread pool is released by file_loaded()
+                    if not channel.waiting:
+                        self.release_request(http_request)
+        # the connection is closing, pipelined leftovers are dropped
+        channel.parser.clear()
+
+    def congested(self, channel):
+        """returns True if the channel has to wait with further requests until its responses are sent"""
+        buffered = channel.buffered_bytes()
+        return buffered > self.send_buffer_size or (buffered > 0 and self.buffered > self.memory_budget)
+
+    def resume(self, channel):
+        """answers requests received by throttled channel once it is not congested"""
+        if channel in self.throttled and not self.congested(channel):
+            self.throttled.discard(channel)
+            channel.throttle(False)
+            self.handle_requests(channel)
+
+    def deadline(self, channel):
+        """returns time when the channel exceeds the timeout of its current state and status line to answer with
+        then ("" to close it without response), time is None while no timeout applies"""
+        if channel.has_output():
+            return channel.last_write + self.write_timeout, ""
+        if channel.waiting or channel in self.throttled:
+            return None, None
+        if channel.request_body is not None:
+            return channel.last_activity + self.body_timeout, "408 Request Timeout"
+        if channel.parser.pending():
+            return channel.head_started + self.header_timeout, "408 Request Timeout"
+        # idle, the first request has to come in header_timeout
+        timeout = self.keepalive_timeout if channel.requests else self.header_timeout
+        return channel.last_activity + timeout, ""
+
+    def watch(self, channel):
+        """arms the timer of channel for its deadline, unless it is armed for an earlier time already. Deadlines
+        which move later (e.g. by last_activity) are found when the timer fires, so it is re-armed only when
+        a state with a shorter timeout starts"""
+        when = self.deadline(channel)[0]
+        if when is None:
+            when = metrics.clock() + 1.0
+        if channel.timer is not None:
+            if channel.timer_due <= when:
+                return
+            channel.timer.cancel()
+        channel.timer_due = when
+        channel.timer = self.call_later(max(when - metrics.clock(), 0.0), self.check_timeout, channel)
+
+    def check_timeout(self, channel):
+        channel.timer = None
+        if not channel.persistent and not channel.has_output():
+            return
+        now = metrics.clock()
+        channel.check_progress(now)
+        if not self.expire(channel, now):
+            self.watch(channel)
+
+    def expire(self, channel, now):
+        """closes channel which exceeded a timeout, returns True in that case"""
+        when, status_line = self.deadline(channel)
+        if when is None or when > now:
+            return False
+        if status_line:
+            self.send_error(channel, status_line)
+        else:
+            channel.abort()
+        return True
+
+    def call_later(self, delay, callback, *args):
+        """runs callback(*args) in the event loop after delay seconds, returns handle with cancel()"""
+        raise NotImplementedError
+
+    def start_timers(self):
+        """schedules the periodic jobs of the event loop: Date header and rescans of document index"""
+        self.refresh_date()
+        if self.document_index is not None:
+            self.call_later(self.document_index.rescan_interval, self.refresh_index)
+
+    def refresh_date(self):
+        now = time()
+        self.header_builder.refresh(now)
+        # just after the next second starts
+        self.call_later(1.0 - now % 1.0 + 0.001, self.refresh_date)
+
+    def refresh_index(self):
+        self.document_index.refresh()
+        self.call_later(self.document_index.rescan_interval, self.refresh_index)
+
+    def start_body(self, channel, http_request):
+        """prepares channel.request_body if the request has a body, returns True in that case"""
+        encoding = http_request.get_header("Transfer-Encoding")
+        length = http_request.get_header("Content-Length")
+        if encoding is not None:
+            if length is not None:
+                raise RequestError("400 Bad Request")
+            if encoding.lower() != "chunked":
+                raise RequestError("501 Not Implemented")
+        elif length is None or length == "0":
+            return False
+        elif not length.isdigit():
+            raise RequestError("400 Bad Request")
+        elif int(length) > self.max_body_size:
+            raise RequestError("413 Payload Too Large")
+        if http_request.http_version == "HTTP/1.1" and \
+                http_request.get_header("Expect", "").lower() == "100-continue":
+            channel.send_response(latin1("HTTP/1.1 100 Continue\r\n\r\n"))
+        channel.request_body = RequestBody(http_request, self.body_sink(http_request), self.max_body_size,
+                                           int(length) if encoding is None else None)
+        return True
+
+    def body_sink(self, http_request):
+        """returns file-like object receiving body of http_request, the request gets it as body.
+        Bodies up to body_spool_size stay in memory, larger ones go to a temporary file"""
+        return tempfile.SpooledTemporaryFile(max_size=self.body_spool_size)
+
+    def send_error(self, channel, status_line):
+        """answers request which can not be parsed and closes the connection"""
+        header = self.header_builder.build("HTTP/1.1 " + status_line, "Content-Length: 0\r\nConnection: close\r\n")
+        channel.send_response(header)
+        channel.end_response(False)
 
     def parse_request(self, request):
-        """returns object of HTTPRequest as certain data structure"""
+        """returns object of HTTPRequest as certain data structure, None for unsupported method.
+        Raises RequestError (400) for malformed request line, (431) for too many header lines"""
         if not request:
             return None
 
-        http_requests = {
-            "HEAD": HEADRequest,
-            "GET": GETRequest,
-            "POST": POSTRequest
-        }
-
-        def parse_request_line(request_line_):
-            method_, uri_, http_version_ = request_line_.split(" ")
-            return method_, uri_, http_version_
-
-        request_lines = request.split("\r\n")
-        request_line = request_lines[0]
-        method, uri, http_version = parse_request_line(request_line)
-        headers = request_lines[1:]
-        body = ""
-        if method in http_requests:
-            return http_requests[method](headers, uri, http_version, body)
-        else:
+        request_lines = native(request).split("\r\n")
+        if len(request_lines) > self.max_headers + 1:
+            raise RequestError("431 Request Header Fields Too Large")
+        request_line = request_lines[0].split(" ")
+        if len(request_line) != 3 or not request_line[1] or not request_line[2].startswith("HTTP/"):
+            raise RequestError("400 Bad Request")
+        method, uri, http_version = request_line
+        if method not in REQUEST_CLASSES:
             return None
+        free = self.free_requests[method]
+        if free:
+            http_request = free.pop()
+            http_request.reset(request_lines[1:], uri, http_version)
+            return http_request
+        return REQUEST_CLASSES[method](request_lines[1:], uri, http_version)
+
+    def release_request(self, http_request):
+        """returns answered request to the free list"""
+        free = self.free_requests[http_request.method]
+        if len(free) < self.free_list_size:
+            http_request.reset(None)
+            free.append(http_request)
 
     def handle_request(self, channel, http_request):
-        """sends response via given channel (HTTPHandler)"""
-        send_content = False
-        content = None
-        status_line = "HTTP/1.0 405 Method Not Allowed"
-        response_headers = {
-                "Host": socket.gethostname(), "Date": HTTPServer.get_date(),
-                "Server": HTTPServer.get_server(), "Connection": "close",
-            }
-        try:
-            if not http_request:
+        """sends response via given channel (HTTPHandler). With fs_offload files are opened (and small ones read)
+        by the thread pool: the channel waits with its next requests until file_loaded() sends the response"""
+        if not http_request:
+            self.respond(channel, http_request, "405 Method Not Allowed")
+            return
+
+        if self.status_url and self.metrics is not None and http_request.uri.partition('?')[0] == self.status_url:
+            body = self.metrics.render().encode("ascii")
+            entity_headers = render_headers((("Content-Type", "text/plain; version=0.0.4"),
+                                             ("Content-Length", len(body))))
+            if http_request.method == "HEAD":
+                self.respond(channel, http_request, "200 OK", entity_headers)
+            else:
+                self.respond(channel, http_request, "200 OK", entity_headers, body, length=len(body))
+            return
+
+        os_path, parameters = self.uri_resolve(http_request)
+
+        if os_path == "Forbidden location":
+            self.respond(channel, http_request, "403 Forbidden")
+            return
+
+        if http_request.method in self.forbidden_methods:
+            self.respond(channel, http_request, "405 Method Not Allowed")
+            return
+
+        if self.document_index is not None and not self.document_index.may_exist(os_path):
+            self.respond(channel, http_request, "404 Not Found")
+            return
+
+        if self.validators is not None and http_request.method in ("GET", "HEAD"):
+            validators = self.validators.get(os_path)
+            if validators is not None and validators.not_modified(http_request):
+                self.respond(channel, http_request, "304 Not Modified",
+                             self.not_modified_headers(http_request, os_path, validators))
                 return
-            os_path, parameters = self.uri_resolve(http_request)
 
-            if os_path is "Forbidden location":
-                status_line = "HTTP/1.0 403 Forbidden"
+        started = metrics.clock()
+        offload = self.fs_offload and self.thread_pool is not None
+        entry = None
+        if self.cache is not None:
+            # stale entries are checked by the thread pool as well
+            entry = self.cache.peek(os_path) if offload else self.cache.get(os_path)
+        if entry is not None and not (offload and self.cache.stale(entry)):
+            if self.metrics is not None:
+                self.metrics.observe(metrics.FILE_OPEN, metrics.clock() - started)
+            self.send_file(channel, http_request, os_path, entry.stat_key, entry)
+        elif offload:
+            read_limit = min(self.cache.max_file_size, self.cache.max_bytes) if self.cache is not None else 0
+            channel.waiting = True
+            self.thread_pool.submit(load_file, (os_path, read_limit, entry.stat_key if entry is not None else None),
+                                    lambda result, error: self.file_loaded(channel, http_request, os_path, entry,
+                                                                           started, result, error))
+        else:
+            try:
+                try:
+                    content = open(os_path, "rb")
+                    st = os.fstat(content.fileno())
+                finally:
+                    if self.metrics is not None:
+                        self.metrics.observe(metrics.FILE_OPEN, metrics.clock() - started)
+                if self.cache is not None and self.cache.fits(st.st_size):
+                    entry = self.cache.load(os_path, content, BaseHTTPServer.detect_content_type(os_path))
+                    content = None
+            except IOError:
+                self.respond(channel, http_request, "404 Not Found")
                 return
-
-            if http_request.method in self.forbidden_methods:
-                status_line = "HTTP/1.0 405 Method Not Allowed"
+            self.send_file(channel, http_request, os_path, FileCache.stat_key(st), entry, content)
+
+    def file_loaded(self, channel, http_request, os_path, entry, started, result, error):
+        """sends response for file opened by load_file() in the thread pool, then goes on with the next
+        requests of the channel"""
+        channel.waiting = False
+        if self.metrics is not None:
+            self.metrics.observe(metrics.FILE_OPEN, metrics.clock() - started)
+        if not channel.persistent:
+            # the connection was closed meanwhile
+            if error is None and result[0] is not None:
+                result[0].close()
+            self.release_request(http_request)
+            return
+        if error is not None:
+            self.respond(channel, http_request,
+                         "404 Not Found" if isinstance(error, EnvironmentError) else "500 Internal Server Error")
+        else:
+            content, st, data = result
+            stat_key = FileCache.stat_key(st)
+            if content is None and data is None:
+                # the cached entry is still valid
+                entry.checked = metrics.clock()
+            elif data is not None:
+                entry = self.cache.insert(os_path, stat_key, BaseHTTPServer.detect_content_type(os_path), data)
+            else:
+                entry = None
+            self.send_file(channel, http_request, os_path, stat_key, entry, content)
+        self.release_request(http_request)
+        if channel.persistent:
+            # reading stops while the channel waits
+            channel.throttle(channel in self.throttled)
+        self.handle_requests(channel)
+
+    def send_file(self, channel, http_request, os_path, stat_key, entry=None, content=None):
+        """answers request for file with given stat_key from cache entry or opened file content"""
+        validators = None
+        if self.validators is not None:
+            validators = self.validators.update(os_path, stat_key)
+            if http_request.method in ("GET", "HEAD") and validators.not_modified(http_request):
+                if content is not None:
+                    content.close()
+                self.respond(channel, http_request, "304 Not Modified",
+                             self.not_modified_headers(http_request, os_path, validators))
                 return
 
-            content = open(os_path, "rb")
-        except IOError:
-            status_line = "HTTP/1.0 404 Not Found"
+        status_line = "200 OK"
+        body = None
+        producers = []
+        size = stat_key[1]
+        content_type = BaseHTTPServer.detect_content_type(os_path)
+        negotiated = self.compression is not None and content_type in self.compression.compressible
+        ranges = None
+        if http_request.method == "GET" and http_request.get_header("Range") is not None:
+            ranges = self.requested_ranges(http_request, stat_key, validators)
+        variant = None
+        if negotiated and ranges is None:
+            variant = self.compression.get(os_path, stat_key, content_type, http_request.get_header("Accept-Encoding"),
+                                           self.thread_pool)
+        if variant is not None:
+            if content is not None:
+                content.close()
+                content = None
+            encoding, entry = variant
+            entity_headers = entry.headers
+            length = len(entry.body)
+            if validators is not None:
+                entity_headers += validators.variant_headers(encoding)
+        elif ranges is not None:
+            entity_headers, body, producers, length = self.partial_content(ranges, content_type, size, entry, content)
+            entry = None
+            content = None
+            if ranges:
+                status_line = "206 Partial Content"
+                if validators is not None:
+                    entity_headers += validators.headers
+            else:
+                status_line = "416 Range Not Satisfiable"
+            if negotiated:
+                entity_headers += "Vary: Accept-Encoding\r\n"
         else:
-            status_line = "HTTP/1.0 200 OK"
-            response_headers["Content-Type"] = HTTPServer.detect_content_type(os_path)
-            response_headers["Content-Length"] = os.path.getsize(os_path)
-
-            if http_request.method is not "HEAD":
-                send_content = True
-        finally:
-            channel.send_response(status_line, **response_headers)
-            log.debug(status_line + " " + http_request.method + " " + http_request.uri)
-            if send_content:
-                channel.push_with_producer(ContentProducer(content))
-            channel.close_when_done()
+            if entry is not None:
+                entity_headers = entry.headers
+            else:
+                entity_headers = render_headers((("Content-Type", content_type), ("Content-Length", size)))
+            entity_headers += "Accept-Ranges: bytes\r\n"
+            length = size
+            if validators is not None:
+                entity_headers += validators.headers
+            if negotiated:
+                entity_headers += "Vary: Accept-Encoding\r\n"
+
+        if http_request.method == "HEAD":
+            length = 0
+            if content is not None:
+                content.close()
+        elif entry is not None:
+            body = entry.body
+        elif content is not None:
+            producers.append(self.file_producer(content))
+        self.respond(channel, http_request, status_line, entity_headers, body, producers, length)
+
+    def respond(self, channel, http_request, status_line, entity_headers="Content-Length: 0\r\n", body=None,
+                producers=(), length=0):
+        """sends status line, headers and body, then producers (and bytes between them) of the response"""
+        protocol = "HTTP/1.0"
+        keep_alive = False
+        if http_request:
+            if http_request.http_version == "HTTP/1.1":
+                protocol = "HTTP/1.1"
+            keep_alive = self.keep_alive(channel, http_request)
+        if keep_alive:
+            connection_headers = "Connection: keep-alive\r\nKeep-Alive: timeout=%d, max=%d\r\n" % (
+                self.keepalive_timeout, self.keepalive_requests - channel.requests)
+        else:
+            connection_headers = "Connection: close\r\n"
+        header = self.header_builder.build(protocol + " " + status_line, entity_headers + connection_headers)
+        channel.send_response(header, body, bool(producers))
+        if self.metrics is not None:
+            self.metrics.inc(metrics.REQUESTS)
+            if status_line[:3] == "404":
+                self.metrics.inc(metrics.NOT_FOUND)
+            if channel.requests == 1:
+                self.metrics.observe(metrics.FIRST_BYTE, metrics.clock() - channel.accepted)
+        if self.access_log is not None and http_request:
+            self.access_log.record(channel.addr[0], time(), http_request.method, http_request.uri,
+                                   http_request.http_version, status_line[:3], length)
+        for index, item in enumerate(producers):
+            if isinstance(item, bytes):
+                channel.send_response(item, None, index < len(producers) - 1)
+            else:
+                channel.push_with_producer(item)
+        channel.end_response(keep_alive)
+
+    def not_modified_headers(self, http_request, os_path, validators):
+        """returns validators of 304 response: of the representation named by If-None-Match, otherwise of the
+        compressed variant a 200 response would have now, with Vary when the encoding is negotiated"""
+        content_type = BaseHTTPServer.detect_content_type(os_path)
+        if self.compression is None or content_type not in self.compression.compressible:
+            return validators.headers
+        encoding = None
+        if_none_match = http_request.get_header("If-None-Match")
+        if if_none_match is not None:
+            encoding = validators.matched_encoding(if_none_match)
+        if encoding is None or encoding and encoding not in self.compression.encodings:
+            variant = self.compression.get(os_path, validators.stat_key, content_type,
+                                           http_request.get_header("Accept-Encoding"), self.thread_pool)
+            encoding = variant[0] if variant is not None else ""
+        headers = validators.variant_headers(encoding) if encoding else validators.headers
+        return headers + "Vary: Accept-Encoding\r\n"
+
+    def requested_ranges(self, http_request, stat_key, validators):
+        """returns byte ranges asked by Range header of GET request, empty list if none can be satisfied,
+        None when the whole file is sent: the header is malformed, ranges overlap too much or If-Range names
+        another version of the file"""
+        if_range = http_request.get_header("If-Range")
+        if if_range is not None:
+            if validators is None:
+                validators = Validators(stat_key, metrics.clock())
+            if not validators.if_range(if_range):
+                return None
+        ranges = parse_range(http_request.get_header("Range"), stat_key[1], self.max_ranges)
+        if ranges and len(ranges) > 1 and sum(last - first + 1 for first, last in ranges) > stat_key[1]:
+            return None
+        return ranges
+
+    def partial_content(self, ranges, content_type, size, entry, content):
+        """returns entity headers, body, producers (and bytes between them) and length of 206 response with
+        ranges of cache entry or opened file content, of 416 response when there are no ranges. Closes content"""
+        if not ranges:
+            if content is not None:
+                content.close()
+            return "Content-Range: bytes */%d\r\nContent-Length: 0\r\n" % size, None, [], 0
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            length = last - first + 1
+            headers = render_headers((("Content-Type", content_type),
+                                      ("Content-Range", "bytes %d-%d/%d" % (first, last, size)),
+                                      ("Content-Length", length)))
+            if entry is not None:
+                return headers, entry.body[first:last + 1], [], length
+            return headers, None, [self.file_producer(content, first, length)], length
+        parts = []
+        for first, last in ranges:
+            parts.append(latin1("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (
+                self.boundary, content_type, first, last, size)))
+            if entry is not None:
+                parts.append(as_bytes(entry.body[first:last + 1]))
+            else:
+                # every part gets its own descriptor, producers close it when they are done
+                parts.append(self.file_producer(os.fdopen(os.dup(content.fileno()), "rb"), first, last - first + 1))
+        parts.append(latin1("\r\n--%s--\r\n" % self.boundary))
+        if content is not None:
+            content.close()
+        length = sum(len(part) if isinstance(part, bytes) else part.remaining for part in parts)
+        headers = render_headers((("Content-Type", "multipart/byteranges; boundary=" + self.boundary),
+                                  ("Content-Length", length)))
+        if entry is not None:
+            return headers, b"".join(parts), [], length
+        return headers, None, parts, length
+
+    def file_producer(self, content, offset=0, count=None):
+        """returns producer sending count bytes of opened file from offset: by sendfile(2) where available,
+        with fs_offload chunks are read by the thread pool"""
+        if self.fs_offload and self.thread_pool is not None:
+            return PrefetchProducer(content, self.thread_pool, offset, count)
+        if self.zero_copy:
+            return SendfileProducer(content, offset, count)
+        return ContentProducer(content, offset=offset, count=count)
 
     def uri_resolve(self, http_request):
         """returns location of requested resource on server and given parameters of request"""
-        uri_parts = http_request.uri.split('?') + [None]
-
-        if '' in uri_parts:
-            uri_parts = filter(lambda a: a != '', uri_parts)
+        path, _, query = http_request.uri.partition('?')
+        parameters = http_request.get_params(query or None)
 
-        parameters = http_request.get_params(uri_parts[1])
+        location = self.resolved.get(path)
+        if location is None:
+            location = self.path_resolve(path)
+            if len(self.resolved) >= self.resolved_limit:
+                self.resolved.clear()
+            self.resolved[path] = location
+        return location, parameters
 
-        resource_location = self.decode_uri(HTTPServer.normalize_uri(uri_parts[0]))
+    def path_resolve(self, path):
+        """returns file system location for path part of uri or "Forbidden location" if it leaves document root"""
+        resource_location = BaseHTTPServer.normalize_uri(BaseHTTPServer.decode_uri(path.partition('#')[0]))
 
-        if resource_location.find("../") != -1:
-            return "Forbidden location", parameters
+        if resource_location is None or '\0' in resource_location:
+            return "Forbidden location"
 
         if resource_location[-1:] == '/':
-            resource_location += HTTPServer.index
+            resource_location += BaseHTTPServer.index
 
-        return self.document_root + resource_location, parameters
+        return self.document_root + resource_location
 
     @staticmethod
     def detect_content_type(filename):
         """returns content type of content (if known) for 'Content-Type' headers"""
-        if filename.endswith(tuple(HTTPServer.__content_types.keys())):
-            return HTTPServer.__content_types[filename.split('.')[-1]]
+        if filename.endswith(tuple(BaseHTTPServer.__content_types.keys())):
+            return BaseHTTPServer.__content_types[filename.split('.')[-1]]
         else:
             return "unknown"
 
     @staticmethod
     def normalize_uri(uri):
-        """returns uri without repeated characters"""
-        repeated_chars = ['/', '?', '#']
-
-        def replace_repeated(dupl, string):
-            while dupl*2 in string:
-                string = string.replace(dupl * 2, dupl)
-            return string
-
-        for duplicate in repeated_chars:
-            uri = replace_repeated(duplicate, uri)
-
-        return uri
+        """returns absolute path without repeated slashes and "." segments, with ".." applied,
+        or None if ".." climbs above the root"""
+        segments = []
+        for segment in uri.split('/'):
+            if segment == '..':
+                if not segments:
+                    return None
+                segments.pop()
+            elif segment and segment != '.':
+                segments.append(segment)
+        trailing = '/' if uri[-1:] == '/' or uri.endswith(('/.', '/..')) else ''
+        if not segments:
+            return '/'
+        return '/' + '/'.join(segments) + trailing
 
     @staticmethod
     def decode_uri(encoded_uri):
-        """returns uri with decoded characters - dictionary for translation is __encoded_chars"""
-        for enc, dec in HTTPServer.__encoded_chars.iteritems():
-            encoded_uri = encoded_uri.replace(enc, dec).replace(enc.lower(), dec)
-        return encoded_uri
+        """returns uri with all %XX escapes decoded in one pass, decoded bytes are taken as utf-8"""
+        if '%' not in encoded_uri:
+            return encoded_uri
+        if not isinstance(encoded_uri, bytes):
+            encoded_uri = encoded_uri.encode("utf-8")
+        hex_bytes = BaseHTTPServer.__hex_bytes
+        pieces = encoded_uri.split(b'%')
+        decoded = [pieces[0]]
+        for piece in pieces[1:]:
+            byte = hex_bytes.get(piece[:2])
+            if byte is None:
+                decoded.append(b'%')
+                decoded.append(piece)
+            else:
+                decoded.append(byte)
+                decoded.append(piece[2:])
+        decoded = b''.join(decoded)
+        if not isinstance(decoded, str):
+            decoded = decoded.decode("utf-8", "surrogateescape")
+        return decoded
 
     @staticmethod
-    def get_date():
+    def get_date(timestamp=None):
         """returns value for 'Date' header"""
-        return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
+        return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(timestamp))
 
     @staticmethod
     def get_server():
@@ -278,31 +1788,619 @@ class HTTPServer(asyncore.dispatcher):
         return platform.system() + " " + platform.release()
 
 
+
+class HTTPServer(BaseHTTPServer, asyncore_epoll.dispatcher):
+
+    def __init__(self, address="", port=8080, document_root="/var/www/html", forbidden="", poller="poll",
+                 keepalive_timeout=15, keepalive_requests=100, cache=None, document_index=None, metrics=None,
+                 status_url=None, access_log=None, max_head_size=16384, max_headers=100,
+                 max_body_size=10 * 1024 * 1024, body_spool_size=65536, validators=None, compression=None,
+                 threads=4, fs_offload=False, send_buffer_size=262144, memory_budget=64 * 1024 * 1024,
+                 header_timeout=10, body_timeout=30, write_timeout=60, tcp_nodelay=True, tcp_cork=True, backlog=None,
+                 listen_socket=None, accept_batch=64):
+        BaseHTTPServer.__init__(self, document_root=document_root, forbidden=forbidden,
+                                keepalive_timeout=keepalive_timeout, keepalive_requests=keepalive_requests,
+                                cache=cache, document_index=document_index, metrics=metrics,
+                                status_url=status_url, access_log=access_log, max_head_size=max_head_size,
+                                max_headers=max_headers, max_body_size=max_body_size,
+                                body_spool_size=body_spool_size, validators=validators, compression=compression,
+                                fs_offload=fs_offload, send_buffer_size=send_buffer_size,
+                                memory_budget=memory_budget, header_timeout=header_timeout,
+                                body_timeout=body_timeout, write_timeout=write_timeout, tcp_nodelay=tcp_nodelay,
+                                tcp_cork=tcp_cork)
+        asyncore_epoll.dispatcher.__init__(self)
+        if threads:
+            # results of the threads wake the poller through a pipe
+            self.waker = asyncore_epoll.waker()
+            self.thread_pool = asyncore_epoll.thread_pool(threads, self.waker.call_soon_threadsafe)
+        self.address = address
+        self.port = port
+        self.poller = asyncore_epoll.get_poller(poller)
+        # timeouts of the connections and periodic jobs
+        self.timers = asyncore_epoll.timer_wheel()
+        # connections taken from the accept queue in one readable event
+        self.accept_batch = accept_batch
+
+        # shared mode: listen_socket was created before fork and all workers accept from one queue
+        if listen_socket is None:
+            listen_socket = listening_socket(self.address, self.port, backlog, reuse_port=True)
+        listen_socket.setblocking(0)
+        self.set_socket(listen_socket)
+        self.accepting = True
+        log.debug("Listening on address %s:%s", address, port)
+
+    def serve_forever(self):
+        self.start_timers()
+        try:
+            while self._map:
+                # Date refresh wakes the poller every second at the latest
+                self.poller(self.timers.timeout(30.0), self._map)
+                if self.metrics is not None:
+                    self.metrics.inc(metrics.POLLER_WAKEUPS)
+                if self.draining and not self.drain():
+                    break
+                self.timers.run()
+        except KeyboardInterrupt:
+            log.debug("Close worker")
+            asyncore_epoll.close_all()
+        finally:
+            self.close()
+            if self.thread_pool is not None:
+                self.thread_pool.close()
+            if self.access_log is not None:
+                self.access_log.close()
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def handle_signals(self, shutdown_timeout):
+        """graceful shutdown on SIGTERM and SIGINT, reload is done by the master"""
+        def stop(signum, frame):
+            self.shutdown(shutdown_timeout)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def drain(self):
+        """stops accepting and closes idle keep-alive connections, new ones wait for their first request
+        until header_timeout, returns False when nothing is left to wait for"""
+        if self.accepting:
+            # connections already in the accept queue of the socket would be reset by close
+            while self.handle_accept():
+                pass
+            self.close()
+            log.debug("Worker stopped accepting, draining connections")
+        busy = False
+        for channel in list(self._map.values()):
+            if not isinstance(channel, HTTPHandler):
+                continue
+            if channel.producer_fifo or channel.parser.pending() or channel.request_body is not None or \
+                    channel.waiting or not channel.requests:
+                busy = True
+            else:
+                channel.close()
+        return busy and metrics.clock() < self.drain_deadline
+
+    def handle_accept(self):
+        """drains up to accept_batch pending connections, returns True when more may be pending"""
+        for _ in range(self.accept_batch):
+            pair = self.accept()
+            if pair is None:
+                return False
+            conn, addr = pair
+            if self.tcp_nodelay:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.free_handlers:
+                self.free_handlers.pop().reuse(conn, addr)
+            else:
+                HTTPHandler(self, sock=conn, addr=addr)
+            if self.metrics is not None:
+                self.metrics.inc(metrics.CONNECTIONS_ACCEPTED)
+                self.metrics.inc(metrics.CONNECTIONS_ACTIVE)
+        return True
+
+
+class AsyncioHTTPHandler(asyncio.Protocol if asyncio is not None else object):
+    """connection of AsyncioHTTPServer, gives handle_request the same interface as HTTPHandler"""
+    __slots__ = ['server', 'metrics', 'transport', 'addr', 'parser', 'request_body', 'waiting', 'requests',
+                 'persistent', 'last_activity', 'accepted', 'output', 'sending', 'paused', 'sendfile_task', 'aborting',
+                 'head_started', 'last_write', 'write_buffer_size', 'timer', 'timer_due']
+
+    # bodies up to this size are written in one buffer together with headers
+    coalesce_size = 16384
+    # bytes of a file sent by one loop.sendfile() call
+    sendfile_part = 1024 * 1024
+
+    def __init__(self, server):
+        self.server = server
+        self.metrics = server.metrics
+        self.parser = RequestParser(server.max_head_size)
+        # output waiting for a file being sent by loop.sendfile() or a chunk being read by PrefetchProducer,
+        # or for the transport buffer to drain: bytes, producers and None for close
+        self.output = deque()
+        self.start()
+
+    def start(self):
+        """initializes the state of the connection, handlers from the free list of the server are started again"""
+        self.transport = None
+        self.addr = None
+        # RequestBody of the request which body is being received
+        self.request_body = None
+        # the response waits for the thread pool
+        self.waiting = False
+        self.requests = 0
+        self.persistent = True
+        self.last_activity = metrics.clock()
+        self.accepted = metrics.clock()
+        self.sending = False
+        self.paused = False
+        # loop.sendfile() in progress, the transport must not be aborted under it
+        self.sendfile_task = None
+        self.aborting = False
+        # when the pending request head started to arrive, when output last made progress
+        self.head_started = self.last_activity
+        self.last_write = self.last_activity
+        self.write_buffer_size = 0
+        # timer of the server checking the timeouts, when it fires
+        self.timer = None
+        self.timer_due = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        # pause_writing() when more than send_buffer_size is buffered
+        transport.set_write_buffer_limits(high=self.server.send_buffer_size)
+        # asyncio sets TCP_NODELAY only on sockets created with IPPROTO_TCP, listening_socket() does not ask for it
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.server.tcp_nodelay))
+        self.server.connections.add(self)
+        self.server.watch(self)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.CONNECTIONS_ACCEPTED)
+            self.metrics.inc(metrics.CONNECTIONS_ACTIVE)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.server.throttled.discard(self)
+        self.persistent = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for item in self.output:
+            if isinstance(item, (SendfileProducer, PrefetchProducer)):
+                item.close()
+        self.output.clear()
+        if self.request_body is not None:
+            self.request_body.close()
+            self.request_body = None
+        if self.metrics is not None:
+            self.metrics.dec(metrics.CONNECTIONS_ACTIVE)
+        # callbacks of the thread pool and of loop.sendfile() still reference the handler
+        if not self.waiting and self.sendfile_task is None and \
+                len(self.server.free_handlers) < self.server.free_list_size:
+            self.transport = None
+            self.server.free_handlers.append(self)
+
+    def data_received(self, data):
+        if self.persistent:
+            if not self.parser.pending():
+                self.head_started = metrics.clock()
+                self.server.watch(self)
+            self.parser.feed(data)
+            if self.waiting:
+                # like readable() of HTTPHandler: no more requests are read until the thread pool answers
+                self.throttle(True)
+            else:
+                self.server.handle_requests(self)
+
+    def pause_writing(self):
+        # the client does not read responses, stop reading its pipelined requests and producing output
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.last_write = metrics.clock()
+        self.transport.resume_reading()
+        # the transport calls this in the middle of its own write, closing it from there would make it lose the
+        # connection twice, so the output is sent after that write returns
+        self.server.loop.call_soon(self.writable, self.transport)
+
+    def writable(self, transport):
+        if transport is self.transport and not transport.is_closing():
+            self.send_queued()
+            self.server.resume(self)
+
+    def buffered_bytes(self):
+        queued = sum(len(item) for item in self.output if item is not None and not hasattr(item, "more"))
+        return self.transport.get_write_buffer_size() + queued
+
+    def has_output(self):
+        return bool(self.sending or self.output or self.transport.get_write_buffer_size())
+
+    def throttle(self, throttled):
+        if throttled:
+            self.transport.pause_reading()
+        elif not self.paused:
+            self.transport.resume_reading()
+
+    def abort(self):
+        if self.sendfile_task is not None:
+            # sendfile_done() aborts the transport once the task is cancelled
+            self.aborting = True
+            self.sendfile_task.cancel()
+        else:
+            self.transport.abort()
+
+    def check_progress(self, now):
+        """notes progress of writes made since the previous check"""
+        size = self.transport.get_write_buffer_size()
+        if size < self.write_buffer_size:
+            self.last_write = now
+        self.write_buffer_size = size
+
+    def write(self, data):
+        if self.sending or self.output:
+            self.output.append(data)
+            return
+        idle = not self.transport.get_write_buffer_size()
+        if idle:
+            self.last_write = metrics.clock()
+        self.transport.write(data)
+        if idle:
+            self.server.watch(self)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.BYTES_SENT, len(data))
+
+    def send_response(self, header, body=None, more=False):
+        """writes rendered status line and headers, small body goes out in the same buffer"""
+        if body is not None and len(body) <= self.coalesce_size:
+            self.write(header + as_bytes(body))
+        else:
+            self.write(header)
+            if body is not None:
+                self.write(body)
+
+    def push_with_producer(self, producer):
+        idle = not self.has_output()
+        if idle:
+            self.last_write = metrics.clock()
+        self.output.append(producer)
+        if not self.sending:
+            self.send_queued()
+        if idle:
+            self.server.watch(self)
+
+    def end_response(self, keep_alive):
+        """waits for the next request on the connection or closes it once the response is sent"""
+        if keep_alive:
+            self.last_activity = metrics.clock()
+            return
+        self.persistent = False
+        if self.sending or self.output:
+            self.output.append(None)
+        else:
+            self.transport.close()
+
+    def send_queued(self):
+        """writes queued output until a file has to be sent, a chunk has to be read or the transport buffer is
+        full, the rest waits for sendfile_done(), prefetched() or resume_writing()"""
+        while self.output and not self.sending and not self.paused:
+            item = self.output.popleft()
+            if item is None:
+                self.transport.close()
+            elif isinstance(item, SendfileProducer):
+                # sent in parts, so write_timeout can see the progress
+                self.sending = True
+                task = asyncio.ensure_future(self.server.loop.sendfile(self.transport, item.fd, item.offset,
+                                                                       min(item.remaining, self.sendfile_part)))
+                task.add_done_callback(lambda future, producer=item: self.sendfile_done(future, producer))
+                self.sendfile_task = task
+            elif isinstance(item, (ContentProducer, PrefetchProducer)):
+                data = item.more()
+                if data is None:
+                    self.output.appendleft(item)
+                    self.sending = True
+                    item.on_ready = self.prefetched
+                elif data:
+                    self.output.appendleft(item)
+                    self.transport.write(data)
+                    if self.metrics is not None:
+                        self.metrics.inc(metrics.BYTES_SENT, len(data))
+                elif isinstance(item, PrefetchProducer) and item.failed:
+                    self.transport.close()
+            else:
+                self.transport.write(item)
+                if self.metrics is not None:
+                    self.metrics.inc(metrics.BYTES_SENT, len(item))
+
+    def sendfile_done(self, future, producer):
+        self.sending = False
+        self.sendfile_task = None
+        if self.aborting or future.cancelled() or future.exception() is not None:
+            producer.close()
+            if self.aborting:
+                self.transport.abort()
+            else:
+                self.transport.close()
+            return
+        sent = future.result()
+        self.last_write = metrics.clock()
+        if self.metrics is not None:
+            self.metrics.inc(metrics.BYTES_SENT, sent)
+        producer.offset += sent
+        producer.remaining -= sent
+        if producer.remaining > 0 and sent:
+            self.output.appendleft(producer)
+        else:
+            producer.close()
+        self.send_queued()
+
+    def prefetched(self):
+        self.sending = False
+        self.send_queued()
+
+    def is_busy(self):
+        return bool(self.sending or self.output or self.parser.pending() or self.request_body is not None or
+                    self.waiting or self.transport.get_write_buffer_size())
+
+
+
+class AsyncioHTTPServer(BaseHTTPServer):
+    """the same request pipeline on asyncio event loop (uvloop when it is installed), files are sent by
+    loop.sendfile(), uvloop lacks it and gets them in chunks written to the transport"""
+
+    def __init__(self, address="", port=8080, document_root="/var/www/html", forbidden="",
+                 keepalive_timeout=15, keepalive_requests=100, cache=None, document_index=None, metrics=None,
+                 status_url=None, access_log=None, max_head_size=16384, max_headers=100,
+                 max_body_size=10 * 1024 * 1024, body_spool_size=65536, validators=None, compression=None,
+                 threads=4, fs_offload=False, send_buffer_size=262144, memory_budget=64 * 1024 * 1024,
+                 header_timeout=10, body_timeout=30, write_timeout=60, tcp_nodelay=True, tcp_cork=True, backlog=None,
+                 listen_socket=None):
+        BaseHTTPServer.__init__(self, document_root=document_root, forbidden=forbidden,
+                                keepalive_timeout=keepalive_timeout, keepalive_requests=keepalive_requests,
+                                cache=cache, document_index=document_index, metrics=metrics,
+                                status_url=status_url, access_log=access_log, max_head_size=max_head_size,
+                                max_headers=max_headers, max_body_size=max_body_size,
+                                body_spool_size=body_spool_size, validators=validators, compression=compression,
+                                fs_offload=fs_offload, send_buffer_size=send_buffer_size,
+                                memory_budget=memory_budget, header_timeout=header_timeout,
+                                body_timeout=body_timeout, write_timeout=write_timeout, tcp_nodelay=tcp_nodelay,
+                                tcp_cork=tcp_cork)
+        self.address = address
+        self.port = port
+        self.loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # uvloop does not implement loop.sendfile(), files are written by transport.write() there
+        self.zero_copy = self.zero_copy and type(self.loop).sendfile is not asyncio.AbstractEventLoop.sendfile
+        if threads:
+            self.thread_pool = asyncore_epoll.thread_pool(threads, self.loop.call_soon_threadsafe)
+        # asyncio listens again with this backlog and accepts up to backlog connections per event
+        self.backlog = backlog or somaxconn()
+        # shared mode: listen_socket was created before fork and all workers accept from one queue
+        if listen_socket is None:
+            listen_socket = listening_socket(self.address, self.port, self.backlog, reuse_port=True)
+        self.listen_socket = listen_socket
+        self.listener = None
+        self.connections = set()
+
+    def serve_forever(self):
+        self.listener = self.loop.run_until_complete(self.loop.create_server(
+            self.new_handler, sock=self.listen_socket, backlog=self.backlog))
+        log.debug("Listening on address %s:%s with %s", self.address, self.port, type(self.loop).__name__)
+        self.start_timers()
+        self.loop.call_later(1.0, self.tick)
+        try:
+            self.loop.run_forever()
+        finally:
+            for connection in list(self.connections):
+                connection.transport.abort()
+            self.listener.close()
+            self.loop.close()
+            if self.thread_pool is not None:
+                self.thread_pool.close()
+            if self.access_log is not None:
+                self.access_log.close()
+
+    def handle_signals(self, shutdown_timeout):
+        """graceful shutdown on SIGTERM and SIGINT, reload is done by the master"""
+        self.loop.add_signal_handler(signal.SIGTERM, self.shutdown, shutdown_timeout)
+        self.loop.add_signal_handler(signal.SIGINT, self.shutdown, shutdown_timeout)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    def new_handler(self):
+        """protocol factory of the listener, handlers of closed connections are reused"""
+        if self.free_handlers:
+            handler = self.free_handlers.pop()
+            handler.parser.clear()
+            handler.start()
+            return handler
+        return AsyncioHTTPHandler(self)
+
+    def tick(self):
+        """once a second: drains connections on shutdown and resumes throttled ones when the worker is within
+        memory_budget, the timeouts have timers of their own"""
+        if self.draining and not self.drain():
+            self.loop.stop()
+            return
+        self.buffered = sum(connection.buffered_bytes() for connection in self.connections)
+        for connection in list(self.throttled):
+            self.resume(connection)
+        self.loop.call_later(1.0, self.tick)
+
+    def drain(self):
+        """stops accepting and closes idle keep-alive connections, new ones wait for their first request
+        until header_timeout, returns False when nothing is left to wait for"""
+        busy = False
+        if self.listener.sockets:
+            # connections already in the accept queue of the socket would be reset by close
+            busy = self.accept_pending()
+            self.listener.close()
+            log.debug("Worker stopped accepting, draining connections")
+        for connection in list(self.connections):
+            if connection.is_busy() or not connection.requests:
+                busy = True
+            else:
+                connection.transport.close()
+        return busy and metrics.clock() < self.drain_deadline
+
+    def accept_pending(self):
+        """hands connections waiting in the accept queue to new handlers, returns True if there were any"""
+        accepted = False
+        while True:
+            try:
+                conn, addr = self.listen_socket.accept()
+            except OSError:
+                return accepted
+            conn.setblocking(False)
+            self.loop.create_task(self.loop.connect_accepted_socket(self.new_handler, conn))
+            accepted = True
+
+
 def run(work):
-    server = HTTPServer(address=server_addr, port=port, document_root=root, forbidden=forbidden_methods)
+    """serves requests in worker number work (0 .. workers - 1)"""
+    access_log = None
+    if access_log_path:
+        access_log = accesslog.AccessLog(access_log_path, log_format=access_log_format,
+                                         buffer_size=access_log_buffer, policy=access_log_policy,
+                                         sample=access_log_sample)
+        access_log.start()
+    cache = None
+    if cache_size:
+        cache = FileCache(max_bytes=cache_size * 1024 * 1024, max_file_size=cache_file_size * 1024,
+                          validity=cache_validity, shared=shared_cache)
+    options = dict(address=server_addr, port=port, document_root=root, forbidden=forbidden_methods,
+                   keepalive_timeout=keepalive_timeout, keepalive_requests=keepalive_requests, cache=cache,
+                   document_index=DocumentIndex(root, index_rescan) if index_rescan else None,
+                   metrics=shared_metrics.worker() if shared_metrics is not None else None,
+                   status_url=status_url, access_log=access_log, max_head_size=max_head_size,
+                   max_headers=max_headers, max_body_size=max_body_size * 1024,
+                   body_spool_size=body_spool_size * 1024, validators=ValidatorCache(cache_validity),
+                   compression=CompressionCache(compression_cache_size * 1024 * 1024, compression_level)
+                   if compression_cache_size else None, threads=threads, fs_offload=fs_offload,
+                   send_buffer_size=send_buffer_size * 1024, memory_budget=memory_budget * 1024 * 1024,
+                   header_timeout=header_timeout, body_timeout=body_timeout, write_timeout=write_timeout,
+                   tcp_nodelay=tcp_nodelay, tcp_cork=tcp_cork, backlog=backlog, listen_socket=shared_socket)
+    if backend == "asyncio":
+        server = AsyncioHTTPServer(**options)
+    else:
+        server = HTTPServer(poller=poller, accept_batch=accept_batch, **options)
+    server.handle_signals(shutdown_timeout)
     server.serve_forever()
 
 
 def help():
-    print "Asynchronous http server. Uses asyncore - the server is dispatcher, \r\n" "http handler is " \
-          "separate class (async_chat) and sending content via fifo producer (ContentProducer class)\r\n " \
-          "Can work in several workers (the default is 10). In current realization supports only http/1.0 " \
-          "without cgi, ssl and only for GET, HEAD, POST methods"
-    print "Parameters description:"
-    print "-h (--help) - print help"
-    print "-r (--root) - set server root directiry for content storing. Default is /var/www/html"
-    print "-p (--port) - listening port for the server. Default is 8080"
-    print "-i (--interface) - interface for listening socket of the server. Default is 0.0.0.0 (all available)"
-    print "-l (--log) - path for logging. Default is console output"
-    print "-w (--workers) - number of process instances (workers) of the server. Default is 10"
-    print "--forbidden_methods - http methods banned for the server (http code 405 will be send). " \
-          "(like POST)"
+    print("Asynchronous http server. Uses asyncore_epoll - the server is dispatcher, \r\n" "http handler is " \
+          "separate class (async_chat) and sending content via fifo producer (SendfileProducer class - " \
+          "zero-copy sendfile(2) where available, ContentProducer class otherwise)\r\n " \
+          "On python 3 the same request handling can run on asyncio (uvloop when installed) instead.\r\n " \
+          "Can work in several workers (the default is 10) forked and supervised by a master process: " \
+          "crashed workers are restarted, SIGHUP reloads workers gracefully, SIGTERM stops them gracefully. " \
+          "In current realization supports http/1.0 and persistent (keep-alive, pipelined) http/1.1 " \
+          "connections with byte ranges (Range, If-Range), without cgi, ssl and only for GET, HEAD, POST methods")
+    print("Parameters description:")
+    print("-h (--help) - print help")
+    print("-r (--root) - set server root directiry for content storing. Default is /var/www/html")
+    print("-p (--port) - listening port for the server. Default is 8080")
+    print("-i (--interface) - interface for listening socket of the server. Default is 0.0.0.0 (all available)")
+    print("-l (--log) - path for logging. Default is console output")
+    print("-w (--workers) - number of process instances (workers) of the server. Default is 10")
+    print("--forbidden_methods - http methods banned for the server (http code 405 will be send). " \
+          "(like POST)")
+    print("--backend - event loop of the workers: asyncore (asyncore_epoll dispatchers) or asyncio " \
+          "(python 3, uses uvloop when it is installed). Default is asyncore")
+    print("--poller - event notification mechanism of the asyncore backend: select, poll, epoll or epoll_et " \
+          "(edge-triggered epoll). Default is epoll where available, poll otherwise")
+    print("--keepalive_timeout - seconds a persistent connection may wait for the next request, " \
+          "0 disables keep-alive. Default is 15")
+    print("--keepalive_requests - maximum number of requests served over one connection. Default is 100")
+    print("--cache_size - memory budget of the per-worker file cache in megabytes, 0 disables it. Default is 64")
+    print("--cache_file_size - files up to this size in kilobytes are cached. Default is 1024")
+    print("--cache_validity - seconds a cached file, or ETag and Last-Modified of any file, are used without " \
+          "checking the file on disk. Default is 1")
+    print("--shared_cache_size - size in megabytes of the file cache shared by all workers through mmap, " \
+          "0 disables it. Default is 0")
+    print("--index_rescan - keep index of files under root in memory and rebuild it every given number of " \
+          "seconds, requests for files not in the index get 404 without file system access. " \
+          "0 disables the index. Default is 0")
+    print("--status_url - path answered with counters and latency histograms of all workers in Prometheus " \
+          "text format (like /__status), empty disables metrics. Default is empty")
+    print("--access_log - file for access log, written in batches by a background thread of every worker. " \
+          "Default is no access log")
+    print("--access_log_format - format of access log records with fields %%(remote_addr)s, %%(time)s, " \
+          "%%(timestamp)f, %%(method)s, %%(uri)s, %%(protocol)s, %%(status)s, %%(bytes)d. " \
+          "Default is Common Log Format: %s" % accesslog.DEFAULT_FORMAT)
+    print("--access_log_buffer - number of records buffered in memory by every worker. Default is 4096")
+    print("--access_log_policy - what to do when the buffer is full: drop the record or block the worker " \
+          "until it is written. Default is drop")
+    print("--access_log_sample - fraction of requests written to access log. Default is 1")
+    print("--max_head_size - maximum size in bytes of request line and headers, longer requests get 431. " \
+          "Default is 16384")
+    print("--max_headers - maximum number of header lines of a request, requests with more get 431. " \
+          "Default is 100")
+    print("--max_body_size - maximum size in kilobytes of a request body (Content-Length or chunked), " \
+          "larger requests get 413. Default is 10240")
+    print("--body_spool_size - request bodies up to this size in kilobytes are kept in memory, larger ones " \
+          "are written to a temporary file as they arrive. Default is 64")
+    print("--compression_cache_size - memory budget in megabytes of every worker for gzip and brotli (when " \
+          "the brotli package is installed) variants of html, css and js files, negotiated by Accept-Encoding; " \
+          "precompressed file.gz and file.br next to the file are used when present. 0 disables compression. " \
+          "Default is 16")
+    print("--compression_level - gzip level (1-9) and brotli quality (0-11) of compression. Default is 6")
+    print("--threads - number of threads of every worker for blocking work like compression, " \
+          "0 does it in the event loop. Default is 4")
+    print("--fs_offload - 1 opens and reads files in the threads of the worker (files are read one chunk ahead " \
+          "instead of sendfile), so slow or network file systems do not stall other connections. Needs threads. " \
+          "Default is 0")
+    print("--send_buffer_size - a connection with more response data in kilobytes queued in memory stops reading " \
+          "and answering its pipelined requests until it is sent. Default is 256")
+    print("--memory_budget - megabytes of response data every worker may queue in memory, above it all connections " \
+          "with queued data wait like above. Default is 64")
+    print("--header_timeout - seconds a client may take to send request head (and the first request on a new " \
+          "connection), it gets 408 after that. Default is 10")
+    print("--body_timeout - seconds a client may pause while sending request body, it gets 408 after that. " \
+          "Default is 30")
+    print("--write_timeout - seconds a connection is closed after when the client does not read its response. " \
+          "Default is 60")
+    print("--tcp_nodelay - 1 sets TCP_NODELAY on connections, every response is written by one call (sendmsg " \
+          "on python 3), so Nagle's algorithm would only delay its last packet. Default is 1")
+    print("--tcp_cork - 1 sets TCP_CORK (Linux only) while the head of a response is sent before its file by " \
+          "sendfile, so they share packets. Default is 1")
+    print("--backlog - length of the queue of pending connections of listening sockets. " \
+          "Default is net.core.somaxconn")
+    print("--accept_batch - maximum number of connections accepted on one readable event by the asyncore " \
+          "backend. Default is 64")
+    print("--cpu_affinity - 1 pins every worker to its own CPU (round robin over allowed CPUs, python 3 only), " \
+          "0 disables it. Default is 1")
+    print("--shutdown_timeout - seconds workers may send responses in progress on graceful shutdown or " \
+          "reload before they are killed. Default is 30")
+    print("--listen_mode - reuseport: every worker has its own SO_REUSEPORT socket and accept queue balanced " \
+          "by the kernel; shared: one socket opened before workers are started. Default is reuseport")
 
 
 if __name__ == "__main__":
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'h:r:p:i:l:w:f', ['root=', 'port=', 'interface=', 'log=',
-                                                                   'workers=', 'forbidden_methods='])
+                                                                   'workers=', 'forbidden_methods=', 'poller=',
+                                                                   'keepalive_timeout=', 'keepalive_requests=',
+                                                                   'cache_size=',
+                                                                   'cache_file_size=', 'cache_validity=',
+                                                                   'shared_cache_size=', 'index_rescan=',
+                                                                   'status_url=', 'access_log=', 'access_log_format=',
+                                                                   'access_log_buffer=', 'access_log_policy=',
+                                                                   'access_log_sample=', 'backlog=', 'accept_batch=',
+                                                                   'listen_mode=', 'cpu_affinity=', 'shutdown_timeout=',
+                                                                   'backend=', 'max_head_size=', 'max_headers=',
+                                                                   'max_body_size=', 'body_spool_size=',
+                                                                   'compression_cache_size=', 'compression_level=',
+                                                                   'threads=', 'fs_offload=', 'send_buffer_size=',
+                                                                   'memory_budget=', 'header_timeout=',
+                                                                   'body_timeout=', 'write_timeout=', 'tcp_nodelay=',
+                                                                   'tcp_cork='])
     except getopt.GetoptError:
         help()
         sys.exit(2)
@@ -313,6 +2411,41 @@ if __name__ == "__main__":
     forbidden_methods = ""
     root = "/var/www/html"
     log_path = None
+    poller = "epoll" if "epoll" in asyncore_epoll.pollers else "poll"
+    keepalive_timeout = 15
+    keepalive_requests = 100
+    cache_size = 64
+    cache_file_size = 1024
+    cache_validity = 1.0
+    shared_cache_size = 0
+    index_rescan = 0
+    status_url = ""
+    access_log_path = ""
+    access_log_format = accesslog.DEFAULT_FORMAT
+    access_log_buffer = 4096
+    access_log_policy = "drop"
+    access_log_sample = 1.0
+    backlog = None
+    accept_batch = 64
+    listen_mode = "reuseport"
+    cpu_affinity = True
+    shutdown_timeout = 30.0
+    backend = "asyncore"
+    max_head_size = 16384
+    max_headers = 100
+    max_body_size = 10240
+    body_spool_size = 64
+    compression_cache_size = 16
+    compression_level = 6
+    threads = 4
+    fs_offload = False
+    send_buffer_size = 256
+    memory_budget = 64
+    header_timeout = 10.0
+    body_timeout = 30.0
+    write_timeout = 60.0
+    tcp_nodelay = True
+    tcp_cork = True
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
@@ -336,6 +2469,91 @@ if __name__ == "__main__":
         elif opt in ('-f', '--forbidden_methods'):
             forbidden_methods = arg.strip('=')
             pass
+        elif opt == '--backend':
+            backend = arg.strip('=')
+            if backend not in BACKENDS:
+                help()
+                sys.exit(2)
+        elif opt == '--poller':
+            poller = arg.strip('=')
+            if poller not in asyncore_epoll.pollers:
+                help()
+                sys.exit(2)
+        elif opt == '--keepalive_timeout':
+            keepalive_timeout = int(arg.strip('='))
+        elif opt == '--keepalive_requests':
+            keepalive_requests = int(arg.strip('='))
+        elif opt == '--cache_size':
+            cache_size = int(arg.strip('='))
+        elif opt == '--cache_file_size':
+            cache_file_size = int(arg.strip('='))
+        elif opt == '--cache_validity':
+            cache_validity = float(arg.strip('='))
+        elif opt == '--shared_cache_size':
+            shared_cache_size = int(arg.strip('='))
+        elif opt == '--index_rescan':
+            index_rescan = float(arg.strip('='))
+        elif opt == '--status_url':
+            status_url = arg.strip('=')
+        elif opt == '--access_log':
+            access_log_path = arg.strip('=')
+        elif opt == '--access_log_format':
+            access_log_format = arg
+            if not accesslog.format_is_valid(access_log_format):
+                help()
+                sys.exit(2)
+        elif opt == '--access_log_buffer':
+            access_log_buffer = int(arg.strip('='))
+        elif opt == '--access_log_policy':
+            access_log_policy = arg.strip('=')
+            if access_log_policy not in accesslog.POLICIES:
+                help()
+                sys.exit(2)
+        elif opt == '--access_log_sample':
+            access_log_sample = float(arg.strip('='))
+        elif opt == '--max_head_size':
+            max_head_size = int(arg.strip('='))
+        elif opt == '--max_headers':
+            max_headers = int(arg.strip('='))
+        elif opt == '--max_body_size':
+            max_body_size = int(arg.strip('='))
+        elif opt == '--body_spool_size':
+            body_spool_size = int(arg.strip('='))
+        elif opt == '--compression_cache_size':
+            compression_cache_size = int(arg.strip('='))
+        elif opt == '--compression_level':
+            compression_level = int(arg.strip('='))
+        elif opt == '--threads':
+            threads = int(arg.strip('='))
+        elif opt == '--fs_offload':
+            fs_offload = arg.strip('=') != "0"
+        elif opt == '--send_buffer_size':
+            send_buffer_size = int(arg.strip('='))
+        elif opt == '--memory_budget':
+            memory_budget = int(arg.strip('='))
+        elif opt == '--header_timeout':
+            header_timeout = float(arg.strip('='))
+        elif opt == '--body_timeout':
+            body_timeout = float(arg.strip('='))
+        elif opt == '--write_timeout':
+            write_timeout = float(arg.strip('='))
+        elif opt == '--tcp_nodelay':
+            tcp_nodelay = arg.strip('=') != "0"
+        elif opt == '--tcp_cork':
+            tcp_cork = arg.strip('=') != "0"
+        elif opt == '--backlog':
+            backlog = int(arg.strip('='))
+        elif opt == '--accept_batch':
+            accept_batch = max(1, int(arg.strip('=')))
+        elif opt == '--cpu_affinity':
+            cpu_affinity = arg.strip('=') != "0"
+        elif opt == '--shutdown_timeout':
+            shutdown_timeout = float(arg.strip('='))
+        elif opt == '--listen_mode':
+            listen_mode = arg.strip('=')
+            if listen_mode not in ("reuseport", "shared"):
+                help()
+                sys.exit(2)
         else:
             pass
 
@@ -344,13 +2562,21 @@ if __name__ == "__main__":
         format="%(process)d: %(message)s", filemode='w', filename=log_path)
     log = logging.getLogger(__name__)
 
-    pool = multiprocessing.Pool(workers)
-    p = pool.map_async(run, range(workers))
-
-    try:
-        results = p.get(0xFFFF)
-    except KeyboardInterrupt:
-        log.debug("parent received control-c")
+    # created before the workers are forked, so all of them map the same pages
+    shared_cache = None
+    if cache_size and shared_cache_size:
+        shared_cache = shmcache.SharedFileCache(shared_cache_size * 1024 * 1024)
+    shared_metrics = None
+    if status_url:
+        # the asyncio loop has no hook for its returns from the poller
+        shared_metrics = metrics.Metrics(workers, omitted=(metrics.POLLER_WAKEUPS,) if backend == "asyncio" else ())
+    shared_socket = None
+    if listen_mode == "shared":
+        shared_socket = listening_socket(server_addr, port, backlog)
+
+    master = prefork.Master(run, workers, cpu_affinity=cpu_affinity, shutdown_timeout=shutdown_timeout,
+                            on_exit=shared_metrics.release if shared_metrics is not None else None)
+    master.run()
 
 
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Counters and latency histograms of the server workers.
+
+All values live in one shared memory array created before the workers are
+forked.  Every worker process claims a row of its own when it starts, so
+updates need no locks, and any worker can sum the rows to answer the status
+URL in Prometheus text format.  Workers of a generation being reloaded keep
+their rows until they exit, then the master folds their counters into the
+first row and frees the row; gauges of exited workers are dropped.
+
+Histograms use HDR-like log-linear buckets: two buckets per power of two
+from about 1 microsecond to 64 seconds, found with one math.frexp() call.
+Durations shorter than the first bound (zero included) fall into the first
+bucket.  Observed durations are measured with clock().
+"""
+import ctypes
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+# monotonic where available (python 3), wall clock steps would give negative or huge durations
+clock = getattr(time, "monotonic", time.time)
+
+# counters and gauges: name, type, help
+COUNTERS = [
+    ("httpd_connections_accepted_total", "counter", "Connections accepted"),
+    ("httpd_connections_active", "gauge", "Connections currently open"),
+    ("httpd_requests_total", "counter", "Requests answered"),
+    ("httpd_responses_not_found_total", "counter", "Requests answered with 404"),
+    ("httpd_bytes_sent_total", "counter", "Bytes written to client sockets"),
+    ("httpd_poller_wakeups_total", "counter", "Returns from the poller of the event loop"),
+]
+(CONNECTIONS_ACCEPTED, CONNECTIONS_ACTIVE, REQUESTS, NOT_FOUND, BYTES_SENT, POLLER_WAKEUPS) = range(len(COUNTERS))
+
+HISTOGRAMS = [
+    ("httpd_first_byte_seconds", "From accept() to the first response byte queued on a connection"),
+    ("httpd_request_parse_seconds", "Time spent parsing request head"),
+    ("httpd_file_open_seconds", "Time spent in open() and stat() of requested files"),
+]
+FIRST_BYTE, PARSE, FILE_OPEN = range(len(HISTOGRAMS))
+
+_MIN_EXPONENT = -19             # first bound is 2 ** -19.5 seconds, about 1.3 microseconds
+_BUCKETS = 2 * 26 + 1           # up to 2 ** 6 seconds, the last bucket is +Inf
+_SQRT_HALF = math.sqrt(0.5)
+# histogram row: buckets, observations, sum in microseconds
+_HISTOGRAM_SIZE = _BUCKETS + 2
+
+BOUNDS = []
+for _exponent in range(_MIN_EXPONENT, _MIN_EXPONENT + (_BUCKETS - 1) // 2):
+    BOUNDS.append(2.0 ** (_exponent - 1) / _SQRT_HALF)
+    BOUNDS.append(2.0 ** _exponent)
+
+
+def bucket(seconds):
+    """returns index of the bucket for given duration"""
+    # frexp(0.0) is (0.0, 0), which would land in the bucket of 0.5 s
+    if seconds <= BOUNDS[0]:
+        return 0
+    mantissa, exponent = math.frexp(seconds)
+    # exact powers of two belong to the bucket they close
+    index = 2 * (exponent - _MIN_EXPONENT) + (mantissa > _SQRT_HALF) - (mantissa == 0.5)
+    if index >= _BUCKETS:
+        return _BUCKETS - 1
+    return index
+
+
+class WorkerMetrics(object):
+    """row of one worker in the shared array"""
+    __slots__ = ['owner', 'values', 'base']
+
+    def __init__(self, owner, base):
+        self.owner = owner
+        self.values = owner.values
+        self.base = base
+
+    def inc(self, counter, value=1):
+        self.values[self.base + counter] += value
+
+    def dec(self, counter, value=1):
+        self.values[self.base + counter] -= value
+
+    def observe(self, histogram, seconds):
+        offset = self.base + len(COUNTERS) + histogram * _HISTOGRAM_SIZE
+        values = self.values
+        values[offset + bucket(seconds)] += 1
+        values[offset + _BUCKETS] += 1
+        values[offset + _BUCKETS + 1] += int(seconds * 1000000)
+
+    def render(self):
+        return self.owner.render()
+
+
+class Metrics(object):
+
+    def __init__(self, workers, generations=4, omitted=()):
+        self.workers = workers
+        # counters the backend of the workers does not update, they are left out of render()
+        self.omitted = frozenset(omitted)
+        self.row_size = len(COUNTERS) + len(HISTOGRAMS) * _HISTOGRAM_SIZE
+        # row 0 keeps counters of exited workers, the others are claimed by running workers, so several
+        # generations of workers can overlap during reloads
+        rows = 1 + workers * generations
+        # signed, gauges go down; created before fork so all workers share it
+        self.values = multiprocessing.RawArray(ctypes.c_longlong, rows * self.row_size)
+        # pid of the worker owning each row, 0 for free rows
+        self.owners = multiprocessing.RawArray(ctypes.c_int, rows)
+        self.lock = multiprocessing.Lock()
+        # values which are summed into row 0 when their worker exits
+        self.kept = [index for index, (_, kind, _) in enumerate(COUNTERS) if kind == "counter"] + \
+            list(range(len(COUNTERS), self.row_size))
+
+    def worker(self):
+        """claims a free row for the calling process, returns None when all rows are taken"""
+        pid = os.getpid()
+        with self.lock:
+            for row in range(1, len(self.owners)):
+                if not self.owners[row]:
+                    self.owners[row] = pid
+                    return WorkerMetrics(self, row * self.row_size)
+        log.warning("No free metrics row for worker %d", pid)
+        return None
+
+    def release(self, pid):
+        """folds counters of exited worker pid into row 0 and frees its row, called by the master"""
+        with self.lock:
+            for row in range(1, len(self.owners)):
+                if self.owners[row] == pid:
+                    base = row * self.row_size
+                    for index in self.kept:
+                        self.values[index] += self.values[base + index]
+                    for index in range(self.row_size):
+                        self.values[base + index] = 0
+                    self.owners[row] = 0
+                    return
+
+    def totals(self):
+        """returns sums of all worker rows"""
+        values = self.values[:]
+        size = self.row_size
+        return [sum(values[i::size]) for i in range(size)]
+
+    def render(self):
+        """returns metrics of all workers in Prometheus text exposition format"""
+        totals = self.totals()
+        lines = ["# HELP httpd_workers Worker processes sharing these metrics",
+                 "# TYPE httpd_workers gauge",
+                 "httpd_workers %d" % self.workers]
+        for index, (name, kind, description) in enumerate(COUNTERS):
+            if index in self.omitted:
+                continue
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("%s %d" % (name, totals[index]))
+        for index, (name, description) in enumerate(HISTOGRAMS):
+            offset = len(COUNTERS) + index * _HISTOGRAM_SIZE
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s histogram" % name)
+            cumulative = 0
+            for bound, count in zip(BOUNDS, totals[offset:offset + _BUCKETS - 1]):
+                cumulative += count
+                lines.append('%s_bucket{le="%.9g"} %d' % (name, bound, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, totals[offset + _BUCKETS]))
+            lines.append("%s_sum %.6f" % (name, totals[offset + _BUCKETS + 1] / 1000000.0))
+            lines.append("%s_count %d" % (name, totals[offset + _BUCKETS]))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Master process which forks server workers and supervises them.
+
+Every worker is a child process running target(index) for its index in
+0 .. workers - 1.  Shared resources (listening socket in shared mode, shared
+file cache, metrics) are created by the master before forking, so they
+survive restarts of the workers.  on_exit(pid) is called by the master for
+every worker which exited, e.g. to release what the worker held in them.
+
+The master polls waitpid(WNOHANG) every check_interval seconds instead of
+handling SIGCHLD: a crashed worker of the current generation is forked
+again with the same index, one second later if it died right after start.
+
+Signals of the master:
+    SIGHUP            graceful reload: a new generation of workers is forked,
+                      then the old one gets SIGTERM and exits once its
+                      responses are sent
+    SIGTERM, SIGINT   graceful shutdown: workers get SIGTERM, the ones still
+                      running after shutdown_timeout seconds are killed
+
+Workers are expected to stop accepting and drain their connections on
+SIGTERM (and SIGINT, which the terminal sends to the whole process group).
+"""
+import logging
+import os
+import signal
+import time
+
+log = logging.getLogger(__name__)
+
+# restart delays and the shutdown deadline must not follow steps of the wall clock
+_clock = getattr(time, "monotonic", time.time)
+
+# a worker which dies sooner than this after start is restarted with a delay
+_MIN_LIFETIME = 1.0
+
+
+def allowed_cpus():
+    """returns sorted list of CPUs this process may run on, None if affinity is not supported"""
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    return sorted(os.sched_getaffinity(0))
+
+
+class Master(object):
+
+    def __init__(self, target, workers, cpu_affinity=True, shutdown_timeout=30.0, check_interval=0.2, on_exit=None):
+        self.target = target
+        self.on_exit = on_exit
+        self.workers = workers
+        self.cpus = allowed_cpus() if cpu_affinity else None
+        self.shutdown_timeout = shutdown_timeout
+        self.check_interval = check_interval
+        # pid -> (index, start time) of the current generation
+        self.children = {}
+        # pid -> index of the previous generations still sending responses
+        self.retiring = {}
+        # index -> time when a crashed worker may be forked again
+        self.pending = {}
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (index, _clock())
+            return pid
+        code = 1
+        try:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            if self.cpus:
+                os.sched_setaffinity(0, [self.cpus[index % len(self.cpus)]])
+            self.target(index)
+            code = 0
+        except Exception:
+            log.exception("Worker %d failed", index)
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def run(self):
+        """forks the workers and supervises them until SIGTERM or SIGINT"""
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        log.debug("Master started %d workers", self.workers)
+        while not self.stop_requested:
+            time.sleep(self.check_interval)
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.restart()
+        self.shutdown()
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def reap(self):
+        """collects exited workers, crashed ones of the current generation are scheduled for restart"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            if self.on_exit is not None:
+                self.on_exit(pid)
+            if pid in self.retiring:
+                del self.retiring[pid]
+                continue
+            if pid not in self.children:
+                continue
+            index, started = self.children.pop(pid)
+            log.debug("Worker %d (pid %d) exited with status %d", index, pid, status)
+            delay = _MIN_LIFETIME if _clock() - started < _MIN_LIFETIME else 0
+            self.pending[index] = _clock() + delay
+
+    def restart(self):
+        now = _clock()
+        for index, when in list(self.pending.items()):
+            if when <= now:
+                del self.pending[index]
+                self.spawn(index)
+
+    def reload(self):
+        """forks new generation of workers, then lets the old one finish its responses"""
+        old = self.children
+        self.children = {}
+        self.pending.clear()
+        for index in range(self.workers):
+            self.spawn(index)
+        for pid, (index, _) in old.items():
+            self.retiring[pid] = index
+            self._signal(pid, signal.SIGTERM)
+        log.debug("Reloaded %d workers", self.workers)
+
+    def shutdown(self):
+        """stops all workers, waits at most shutdown_timeout seconds for their responses to be sent"""
+        for pid, (index, _) in self.children.items():
+            self.retiring[pid] = index
+            self._signal(pid, signal.SIGTERM)
+        self.children = {}
+        self.pending.clear()
+        deadline = _clock() + self.shutdown_timeout
+        while self.retiring and _clock() < deadline:
+            time.sleep(self.check_interval)
+            self.reap()
+        for pid in list(self.retiring):
+            self._signal(pid, signal.SIGKILL)
+        while self.retiring:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except OSError:
+                break
+            self.retiring.pop(pid, None)
+        log.debug("Master stopped")
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
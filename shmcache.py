@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""File cache shared by all workers of the server.
+
+The arena is an anonymous MAP_SHARED mmap created by the parent process
+before the workers are forked, so every worker sees the same physical
+pages.  It holds an open addressing index of fixed size slots followed by
+an append-only data region:
+
+    header | slot * slots | key, body | key, body | ...
+
+Data is never overwritten: a file changed on disk gets a new copy appended
+and its slot is repointed, so bytes a worker is still sending can not be
+modified by another one.  Once the data region or the index is full new
+files are not shared any more and stay in the per-worker FileCache.  The
+arena is never reclaimed while the server runs, because workers keep views
+of shared bodies in their caches and responses, so its size has to fit the
+files worth sharing; every worker logs a warning when it finds it full.
+
+Slots are published with a sequence counter (odd while being written), so
+readers never take the lock; writers use a non-blocking lock and simply
+skip sharing when another worker holds it.
+"""
+import logging
+import mmap
+import multiprocessing
+import struct
+import zlib
+
+_MAGIC = b"HTTPDSHM"
+_HEADER = struct.Struct("<8sQQQ")      # magic, slots, data size, used
+# sequence, key hash, key length, reserved, data offset, body length, inode, mtime
+_SLOT = struct.Struct("<QQIIQQQd")
+# keeps lookups cheap when the index is almost full
+_MAX_PROBES = 32
+
+log = logging.getLogger(__name__)
+
+try:
+    buffer
+
+    def _view(mm, offset, length):
+        # mmap has no new-style buffer interface on python 2
+        return buffer(mm, offset, length)
+except NameError:
+    def _view(mm, offset, length):
+        return memoryview(mm)[offset:offset + length]
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode("utf-8", "surrogateescape")
+
+
+class SharedFileCache(object):
+
+    def __init__(self, size=256 * 1024 * 1024, slots=16384):
+        self.slots = slots
+        self.data_start = _HEADER.size + slots * _SLOT.size
+        if size <= self.data_start:
+            raise ValueError("shared cache of %d bytes can not hold %d slots" % (size, slots))
+        self.data_size = size - self.data_start
+        self.mm = mmap.mmap(-1, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        _HEADER.pack_into(self.mm, 0, _MAGIC, slots, self.data_size, 0)
+        self.lock = multiprocessing.Lock()
+        # the warning about the full data region is logged once by every worker
+        self.full = False
+
+    def _slot_offset(self, index):
+        return _HEADER.size + index * _SLOT.size
+
+    def _probe(self, key, key_hash):
+        """yields (index, fields) of slots on the probing path of key until the first empty one"""
+        mm = self.mm
+        start = key_hash % self.slots
+        for i in range(min(self.slots, _MAX_PROBES)):
+            index = (start + i) % self.slots
+            fields = _SLOT.unpack_from(mm, self._slot_offset(index))
+            yield index, fields
+            if not fields[0]:
+                return
+
+    def _key_matches(self, fields, key, key_hash):
+        seq, slot_hash, key_len, _, offset = fields[:5]
+        return (seq and slot_hash == key_hash and key_len == len(key) and
+                self.mm[offset:offset + key_len] == key)
+
+    def get(self, path, stat_key):
+        """returns read-only view of cached body if it matches stat_key (inode, size, mtime), else None"""
+        key = _encode(path)
+        key_hash = zlib.crc32(key) & 0xffffffff
+        for index, fields in self._probe(key, key_hash):
+            if not self._key_matches(fields, key, key_hash):
+                continue
+            seq, _, key_len, _, offset, length, ino, mtime = fields
+            if seq & 1 or (ino, length, mtime) != stat_key:
+                return None
+            # the slot could be repointed while we were comparing the key
+            if _SLOT.unpack_from(self.mm, self._slot_offset(index))[0] != seq:
+                return None
+            return _view(self.mm, offset + key_len, length)
+        return None
+
+    def put(self, path, stat_key, body):
+        """copies body into the arena and returns view of the shared copy, None if there is no room or body
+        does not have the size of stat_key"""
+        key = _encode(path)
+        key_hash = zlib.crc32(key) & 0xffffffff
+        ino, length, mtime = stat_key
+        # the file could have changed while it was read
+        if body is None or len(body) != length:
+            return None
+        if len(key) + length > self.data_size:
+            log.debug("%s of %d bytes does not fit into the shared cache", path, length)
+            return None
+        if not self.lock.acquire(False):
+            return None
+        try:
+            free = None
+            for index, fields in self._probe(key, key_hash):
+                if not fields[0] or self._key_matches(fields, key, key_hash):
+                    free = index, fields[0]
+                    break
+            if free is None:
+                return None
+            index, seq = free
+
+            _, _, _, used = _HEADER.unpack_from(self.mm, 0)
+            if used + len(key) + length > self.data_size:
+                if not self.full:
+                    self.full = True
+                    log.warning("Shared cache is full (%d of %d bytes used), new files are cached by every worker "
+                                "on its own", used, self.data_size)
+                return None
+            offset = self.data_start + used
+            self.mm[offset:offset + len(key)] = key
+            self.mm[offset + len(key):offset + len(key) + length] = body
+            _HEADER.pack_into(self.mm, 0, _MAGIC, self.slots, self.data_size, used + len(key) + length)
+
+            slot_offset = self._slot_offset(index)
+            _SLOT.pack_into(self.mm, slot_offset, seq + 1, key_hash, len(key), 0, offset, length, ino, mtime)
+            struct.pack_into("<Q", self.mm, slot_offset, seq + 2)
+            return _view(self.mm, offset + len(key), length)
+        finally:
+            self.lock.release()